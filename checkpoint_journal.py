@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+from time import monotonic
+from typing import Dict
+
+
+class CheckpointJournal:
+    """Append-only journal of finished work, so a crashed run can be resumed.
+
+    Every record is one json line {"kind": ..., "key": ..., "value": ...}.
+    Records are buffered and written in batches, either when `batch_size`
+    records are waiting or `flush_interval` seconds have passed, so
+    checkpointing costs one write and fsync per batch instead of per item.
+
+    Example:
+        with CheckpointJournal("run.journal") as journal:
+            done = journal.replay()
+            if url not in done["stats"]:
+                journal.record("stats", url, fetch(url))
+    """
+
+    def __init__(self, path: str, batch_size: int = 50, flush_interval: float = 5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = monotonic()
+        self.lock = threading.Lock()
+        self.file = None
+
+    def replay(self) -> Dict[str, dict]:
+        """Read back everything committed to the journal.
+
+        returns:
+            done (dict) : {kind: {key: value}}, later records of the same
+                kind and key replace earlier ones
+        """
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # A line cut off by a crash while writing it
+                    continue
+                done.setdefault(item["kind"], {})[item["key"]] = item["value"]
+        return done
+
+    def record(self, kind: str, key: str, value) -> None:
+        """Add a finished item, it is committed with the next batch.
+
+        arguments:
+            kind (str) : kind of work, e.g. 'players' or 'stats'
+            key (str) : what the work was done for, e.g. a url
+            value : json serializable result
+        """
+        line = json.dumps({"kind": kind, "key": key, "value": value})
+        with self.lock:
+            self.buffer.append(line)
+            if (
+                len(self.buffer) >= self.batch_size
+                or monotonic() - self.last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def flush(self) -> None:
+        """Commit all buffered records to disk."""
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        self.last_flush = monotonic()
+        if not self.buffer:
+            return
+        if self.file is None:
+            self._drop_partial_line()
+            self.file = open(self.path, "a")
+        self.file.write("\n".join(self.buffer) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.buffer = []
+
+    def close(self) -> None:
+        """Commit buffered records and close the journal file."""
+        with self.lock:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def finish(self) -> None:
+        """Close and delete the journal once the run it checkpoints succeeded,
+        so the next run starts from scratch instead of replaying it."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _drop_partial_line(self) -> None:
+        # Cut off a line left half written by a crash, so new records start on a line of their own
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,433 @@
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import threading
+from time import sleep, time
+from typing import Dict, List, Optional
+
+import fetch_player_statistics
+from profiling import Profiler, clear_profiles, merge_profiles
+from requesting_urls import FetchError
+
+
+class WorkQueue:
+    """Queue of shards of work, shared between workers through an SQLite file.
+
+    Workers lease a shard for `lease_seconds` and keep the lease alive with
+    heartbeats while working on it. A shard whose lease ran out (because
+    its worker crashed) is handed out again, until it has been leased
+    max_attempts times, then it fails. The file can live on a
+    filesystem shared between several machines, as long as it supports
+    file locking.
+
+    Every shard is a row with a kind ('players' or 'stats'), a json
+    payload, a state ('pending', 'leased', 'done' or 'failed') and,
+    when done, a json result.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 5):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT
+            )
+            """
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+
+    def set_setting(self, key: str, value: str) -> None:
+        self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, value))
+
+    def get_setting(self, key: str, default: str = None) -> str:
+        row = self.db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def enqueue(self, kind: str, items: list, shard_size: int) -> None:
+        """Split items into shards of at most shard_size items and queue them."""
+        rows = [
+            (kind, json.dumps(items[i:i + shard_size]))
+            for i in range(0, len(items), shard_size)
+        ]
+        self.db.executemany("INSERT INTO shards (kind, payload) VALUES (?, ?)", rows)
+
+    def lease(self, worker: str, lease_seconds: float) -> Optional[dict]:
+        """Lease a pending shard, or one whose lease ran out.
+
+        A shard whose lease ran out after max_attempts leases fails for good,
+        since it seems to take down every worker that leases it.
+
+        returns:
+            shard (dict) : {'id', 'kind', 'items'}, or None if nothing is available
+        """
+        now = time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(
+                """
+                UPDATE shards SET state = 'failed', worker = NULL, lease_expires = NULL,
+                error = 'lease ran out ' || attempts || ' times, its workers crashed'
+                WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?
+                """,
+                (now, self.max_attempts),
+            )
+            row = self.db.execute(
+                """
+                SELECT id, kind, payload FROM shards
+                WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)
+                ORDER BY id LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row:
+                self.db.execute(
+                    """
+                    UPDATE shards SET state = 'leased', worker = ?, lease_expires = ?,
+                    attempts = attempts + 1 WHERE id = ?
+                    """,
+                    (worker, now + lease_seconds, row[0]),
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        if not row:
+            return None
+        return {"id": row[0], "kind": row[1], "items": json.loads(row[2])}
+
+    def heartbeat(self, shard_id: int, worker: str, lease_seconds: float) -> bool:
+        """Extend a lease, returns False if the worker lost it."""
+        cursor = self.db.execute(
+            """
+            UPDATE shards SET lease_expires = ?
+            WHERE id = ? AND worker = ? AND state = 'leased'
+            """,
+            (time() + lease_seconds, shard_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def complete(
+        self,
+        shard_id: int,
+        worker: str,
+        result,
+        follow_up: Dict[str, list] = None,
+        shard_size: int = 1,
+    ) -> bool:
+        """Store the result of a shard, and queue the work that follows from it.
+
+        Both happen in one transaction, and only if the worker still holds the lease.
+
+        arguments:
+            shard_id (int) : the leased shard
+            worker (str) : the worker holding the lease
+            result : json serializable result
+            follow_up (dict) : {kind: items} to queue
+            shard_size (int) : shard size for the follow up items
+        returns:
+            (bool) : False if the lease was lost and the result dropped
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.db.execute(
+                """
+                UPDATE shards SET state = 'done', result = ?, lease_expires = NULL
+                WHERE id = ? AND worker = ? AND state = 'leased'
+                """,
+                (json.dumps(result), shard_id, worker),
+            )
+            if cursor.rowcount == 1:
+                for kind, items in (follow_up or {}).items():
+                    self.enqueue(kind, items, shard_size)
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def release(self, shard_id: int, worker: str, error: str) -> None:
+        """Give a shard back after an error, it fails for good after max_attempts."""
+        self.db.execute(
+            """
+            UPDATE shards SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+            worker = NULL, lease_expires = NULL, error = ?
+            WHERE id = ? AND worker = ? AND state = 'leased'
+            """,
+            (self.max_attempts, error, shard_id, worker),
+        )
+
+    def unfinished(self) -> int:
+        """Number of shards that are pending or leased."""
+        row = self.db.execute(
+            "SELECT COUNT(*) FROM shards WHERE state IN ('pending', 'leased')"
+        ).fetchone()
+        return row[0]
+
+    def results(self, kind: str) -> list:
+        """Results of all done shards of a kind."""
+        rows = self.db.execute(
+            "SELECT result FROM shards WHERE kind = ? AND state = 'done' ORDER BY id",
+            (kind,),
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def errors(self) -> Dict[int, str]:
+        """Errors of shards that failed for good: {shard id: error}"""
+        rows = self.db.execute("SELECT id, error FROM shards WHERE state = 'failed'")
+        return dict(rows.fetchall())
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def start_crawl(url: str, queue_path: str, shard_size: int = 10) -> None:
+    """Queue a crawl of the best players in the semifinals.
+
+    The teams are found right away, every team becomes a 'players' shard.
+    Workers turn those into 'stats' shards of shard_size players.
+
+    arguments:
+        url (str) : url of the nba playoffs wikipedia page
+        queue_path (str) : sqlite file of the work queue
+        shard_size (int) : players per 'stats' shard
+    """
+    teams = fetch_player_statistics.get_teams(url)
+    assert len(teams) == 8
+    queue = WorkQueue(queue_path)
+    queue.db.execute("BEGIN IMMEDIATE")
+    queue.set_setting("shard_size", str(shard_size))
+    queue.enqueue("players", teams, 1)
+    queue.db.execute("COMMIT")
+    queue.close()
+
+
+def run_worker(
+    queue_path: str,
+    worker: str = None,
+    lease_seconds: float = 60,
+    poll_interval: float = 1.0,
+    profile_dir: str = None,
+) -> None:
+    """Work on shards of the queue until all of them are finished.
+
+    arguments:
+        queue_path (str) : sqlite file of the work queue
+        worker (str) : unique name of this worker, defaults to host and pid
+        lease_seconds (float) : how long a lease lasts without a heartbeat
+        poll_interval (float) : seconds to wait when other workers hold all shards
+        profile_dir (str) : profile the worker into this directory, see profiling.Profiler
+    """
+    if profile_dir:
+        with Profiler(profile_dir):
+            run_worker(queue_path, worker, lease_seconds, poll_interval)
+        return
+
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    queue = WorkQueue(queue_path)
+    shard_size = int(queue.get_setting("shard_size", "10"))
+
+    while True:
+        shard = queue.lease(worker, lease_seconds)
+        if shard is None:
+            if queue.unfinished() == 0:
+                break
+            # Other workers hold the rest, their leases may still run out
+            sleep(poll_interval)
+            continue
+
+        # Keep the lease alive from another thread (and connection) while working
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=_heartbeat,
+            args=(queue_path, shard["id"], worker, lease_seconds, stop),
+            daemon=True,
+        )
+        heartbeat.start()
+        try:
+            result, follow_up = process_shard(shard)
+        except Exception as e:
+            queue.release(shard["id"], worker, f"{type(e).__name__}: {e}")
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+        queue.complete(shard["id"], worker, result, follow_up, shard_size)
+
+    queue.close()
+
+
+def _heartbeat(
+    queue_path: str,
+    shard_id: int,
+    worker: str,
+    lease_seconds: float,
+    stop: threading.Event,
+) -> None:
+    """Extends a lease every third of its length, until stopped or the lease is lost."""
+    queue = WorkQueue(queue_path)
+    while not stop.wait(lease_seconds / 3):
+        if not queue.heartbeat(shard_id, worker, lease_seconds):
+            break
+    queue.close()
+
+
+def process_shard(shard: dict):
+    """Do the work of one shard.
+
+    returns:
+        result, follow_up : the json result, and {kind: items} of new work
+    """
+    if shard["kind"] == "players":
+        players = {}
+        failures = {}
+        for team in shard["items"]:
+            try:
+                players[team["name"]] = fetch_player_statistics.get_players(team["url"])
+            except FetchError as e:
+                players[team["name"]] = []
+                failures[e.url] = e.reason
+        player_urls = [p["url"] for team_players in players.values() for p in team_players]
+        return {"players": players, "failures": failures}, {"stats": player_urls}
+
+    if shard["kind"] == "stats":
+        indexes = {}
+        failures = {}
+        for player_url in shard["items"]:
+            try:
+                indexes[player_url] = fetch_player_statistics.get_player_stats_index(player_url)
+            except FetchError as e:
+                failures[e.url] = e.reason
+        return {"stats": indexes, "failures": failures}, {}
+
+    raise ValueError(f"unknown shard kind {shard['kind']}")
+
+
+def merge_results(queue_path: str, season: str = "2021") -> Dict[str, List[Dict]]:
+    """Merge the results of all workers into the top 3 of every team.
+
+    arguments:
+        queue_path (str) : sqlite file of a finished work queue
+        season (str) : the starting year of the season
+    returns:
+        best (dict) : the top 3 players of every team, ready for plot_best
+    """
+    queue = WorkQueue(queue_path)
+    all_players = {}
+    failures = {}
+    for result in queue.results("players"):
+        all_players.update(result["players"])
+        failures.update(result["failures"])
+    indexes = {}
+    for result in queue.results("stats"):
+        indexes.update(result["stats"])
+        failures.update(result["failures"])
+    errors = queue.errors()
+    queue.close()
+
+    for failed_url, reason in failures.items():
+        print(f"Could not fetch {failed_url}: {reason}")
+    for shard_id, error in errors.items():
+        print(f"Shard {shard_id} failed: {error}")
+
+    best = {}
+    for team, players in all_players.items():
+        for p in players:
+            stats = fetch_player_statistics.lookup_stats(indexes.get(p["url"], {}), season, team)
+            for key in ("points", "assists", "rebounds"):
+                p[key] = stats.get(key, 0.0)
+        best[team] = fetch_player_statistics.select_top_3(players)
+    return best
+
+
+def crawl_best_players(
+    url: str,
+    queue_path: str,
+    processes: int = 4,
+    profile_dir: str = None,
+) -> None:
+    """Crawl the best players with several worker processes on this machine, then plot.
+
+    Workers on other machines can join with
+    `python crawl_coordinator.py worker <queue_path>`. An unfinished queue
+    (e.g. after a crash) is resumed, a finished one is replaced by a new crawl.
+
+    arguments:
+        url (str) : url of the nba playoffs wikipedia page
+        queue_path (str) : sqlite file of the work queue
+        processes (int) : number of local worker processes
+        profile_dir (str) : profile every worker into this directory and
+            print the merged summary at the end
+    raises:
+        RuntimeError : if shards are still unfinished when all local workers
+            stopped, nothing is plotted then
+    """
+    if os.path.exists(queue_path):
+        queue = WorkQueue(queue_path)
+        finished = queue.unfinished() == 0
+        queue.close()
+        if finished:
+            os.remove(queue_path)
+    if not os.path.exists(queue_path):
+        start_crawl(url, queue_path)
+    if profile_dir:
+        clear_profiles(profile_dir)
+    workers = [
+        multiprocessing.Process(
+            target=run_worker, args=(queue_path,), kwargs={"profile_dir": profile_dir}
+        )
+        for _ in range(processes)
+    ]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    queue = WorkQueue(queue_path)
+    unfinished = queue.unfinished()
+    queue.close()
+    if unfinished:
+        exitcodes = [p.exitcode for p in workers]
+        raise RuntimeError(
+            f"{unfinished} shards are unfinished, workers exited with {exitcodes}; "
+            "run the crawl again to resume it"
+        )
+
+    best = merge_results(queue_path)
+    for stat in ["points", "assists", "rebounds"]:
+        fetch_player_statistics.plot_best(best, stat=stat)
+    if profile_dir:
+        print(merge_profiles(profile_dir))
+
+
+if __name__ == "__main__":
+    usage = (
+        "usage: python crawl_coordinator.py crawl <queue> [processes] [--profile]\n"
+        "       python crawl_coordinator.py worker <queue> [--profile]"
+    )
+    profile_dir = "profile" if "--profile" in sys.argv else None
+    if profile_dir:
+        sys.argv.remove("--profile")
+    if len(sys.argv) < 3:
+        sys.exit(usage)
+    command, queue_path = sys.argv[1], sys.argv[2]
+    url = "https://en.wikipedia.org/wiki/2022_NBA_playoffs"
+    if command == "crawl":
+        processes = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+        crawl_best_players(url, queue_path, processes, profile_dir)
+    elif command == "worker":
+        run_worker(queue_path, profile_dir=profile_dir)
+    else:
+        sys.exit(usage)
@@ -0,0 +1,255 @@
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+from requesting_urls import title_from_url
+
+# stats read from the career tables, see fetch_player_statistics.stats_columns
+base_columns = [
+    "games",
+    "games_started",
+    "minutes",
+    "fg_pct",
+    "three_pct",
+    "ft_pct",
+    "rebounds",
+    "assists",
+    "steals",
+    "blocks",
+    "points",
+]
+
+# registered metrics: {name: function of a StatsTable returning one value per row}
+metrics = {}
+
+
+class StatsTable:
+    """Every (player, season, team) row of many career tables, as numpy columns.
+
+    The text columns are url, name, season and team, the numeric columns are
+    base_columns (nan where a table lacks the stat) and any computed metrics.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+
+    @classmethod
+    def from_indexes(
+        cls,
+        indexes: Dict[str, Dict[str, Dict[str, dict]]],
+        names: Dict[str, str] = None,
+    ) -> "StatsTable":
+        """Build a table from parsed player stats indexes.
+
+        arguments:
+            indexes (dict) : {player url: {season: {team: stats}}}, e.g. the
+                parsed-result store of fetch_player_statistics
+            names (dict) : optional {player url: name}, defaults to the article title
+        returns:
+            table (StatsTable)
+        """
+        names = names or {}
+        rows = [
+            (url, season, team, stats)
+            for url, index in indexes.items()
+            for season, teams in index.items()
+            for team, stats in teams.items()
+        ]
+        columns = {
+            "url": np.array([row[0] for row in rows], dtype=object),
+            "name": np.array(
+                [names.get(row[0]) or title_from_url(row[0]) for row in rows], dtype=object
+            ),
+            "season": np.array([row[1] for row in rows], dtype=object),
+            "team": np.array([row[2] for row in rows], dtype=object),
+        }
+        for key in base_columns:
+            columns[key] = np.array(
+                [row[3].get(key, np.nan) for row in rows], dtype=float
+            )
+        return cls(columns)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self.columns and name in metrics:
+            self.columns[name] = metrics[name](self)
+        return self.columns[name]
+
+    def __len__(self) -> int:
+        return len(self.columns["url"])
+
+    def compute(self, names: Iterable[str] = None) -> "StatsTable":
+        """Compute registered metrics (all of them by default) for every row."""
+        for name in names if names is not None else list(metrics):
+            self[name]
+        return self
+
+
+def register_metric(name: str, func: Callable[[StatsTable], np.ndarray] = None):
+    """Register a metric, computed from the columns of a StatsTable.
+
+    The function gets the table and must return an array with a value
+    for every row. It can be used as a decorator:
+
+        @register_metric("stocks")
+        def stocks(table):
+            return table["steals"] + table["blocks"]
+
+    or called directly:
+
+        register_metric("pra", lambda t: t["points"] + t["rebounds"] + t["assists"])
+    """
+    if func is None:
+        return lambda f: register_metric(name, f)
+    metrics[name] = func
+    return func
+
+
+def group_codes(*keys: np.ndarray) -> np.ndarray:
+    """Number the distinct combinations of some key columns, one code per row."""
+    codes = np.zeros(len(keys[0]), dtype=np.int64)
+    for key in keys:
+        uniques, inverse = np.unique(key.astype(str), return_inverse=True)
+        codes = codes * len(uniques) + inverse
+    return np.unique(codes, return_inverse=True)[1]
+
+
+def group_sum(values: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """Sum of the values of every group, repeated for each row (nan counts as 0)."""
+    return np.bincount(codes, weights=np.nan_to_num(values))[codes]
+
+
+def group_zscore(values: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """How many standard deviations each value is from the mean of its group."""
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    count = np.bincount(codes, weights=valid.astype(float))
+    mean = np.bincount(codes, weights=filled) / np.maximum(count, 1)
+    square = np.bincount(codes, weights=np.where(valid, (filled - mean[codes]) ** 2, 0.0))
+    std = np.sqrt(square / np.maximum(count, 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(valid & (std[codes] > 0), (filled - mean[codes]) / std[codes], np.nan)
+
+
+def _per_36(key: str) -> Callable[[StatsTable], np.ndarray]:
+    def per_36(table):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(table["minutes"] > 0, table[key] / table["minutes"] * 36, np.nan)
+    return per_36
+
+
+for _key in ["points", "assists", "rebounds", "steals", "blocks"]:
+    register_metric(f"{_key}_per_36", _per_36(_key))
+    register_metric(
+        f"{_key}_z",
+        lambda table, key=_key: group_zscore(table[key], group_codes(table["season"])),
+    )
+
+register_metric("pra", lambda t: t["points"] + t["rebounds"] + t["assists"])
+register_metric("stocks", lambda t: t["steals"] + t["blocks"])
+
+
+@register_metric("scoring_share")
+def scoring_share(table: StatsTable) -> np.ndarray:
+    """Share of the points per game of the team (among the players in the table),
+    a rough stand-in for usage rate."""
+    total = group_sum(table["points"], group_codes(table["season"], table["team"]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, table["points"] / total, np.nan)
+
+
+@register_metric("minutes_share")
+def minutes_share(table: StatsTable) -> np.ndarray:
+    """Share of the minutes per game of the team (among the players in the table)."""
+    total = group_sum(table["minutes"], group_codes(table["season"], table["team"]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, table["minutes"] / total, np.nan)
+
+
+def rank(
+    table: StatsTable,
+    metric: str,
+    season: str = "2021",
+    teams: List[str] = None,
+    k: int = 3,
+) -> Dict[str, List[Dict]]:
+    """The top k players of every team in a season by a metric.
+
+    arguments:
+        table (StatsTable) : the stats
+        metric (str) : a column or registered metric
+        season (str) : the starting year of the season
+        teams (list) : optional full or short team names to keep (e.g. 'Golden State')
+        k (int) : players per team
+    returns:
+        best (dict) : {team: [{"name": ..., metric: ..., "points": ...}, ...]},
+            in the form plot_best takes
+    """
+    values = table[metric]
+    mask = table["season"] == season
+    if teams is not None:
+        team_names = np.unique(table["team"][mask].astype(str))
+        keep = [t for t in team_names if any(short in t for short in teams)]
+        mask &= np.isin(table["team"].astype(str), keep)
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return {}
+
+    # Sort by team, then best value first, with missing values last
+    sort_values = np.where(np.isnan(values[rows]), -np.inf, values[rows])
+    order = rows[np.lexsort((-sort_values, table["team"][rows].astype(str)))]
+
+    # Keep the first k rows of every team
+    sorted_teams = table["team"][order].astype(str)
+    positions = np.arange(len(order))
+    starts = np.r_[True, sorted_teams[1:] != sorted_teams[:-1]]
+    group_start = np.maximum.accumulate(np.where(starts, positions, 0))
+    top = order[positions - group_start < k]
+
+    best = {}
+    for row in top:
+        player = {"name": table["name"][row]}
+        for key in ["points", "assists", "rebounds", metric]:
+            player[key] = float(table[key][row])
+        best.setdefault(table["team"][row], []).append(player)
+    return best
+
+
+def leaders(table: StatsTable, metric: str, season: str = "2021", k: int = 10) -> List[Dict]:
+    """The top k rows of a season by a metric, over all teams.
+
+    arguments:
+        table (StatsTable) : the stats
+        metric (str) : a column or registered metric
+        season (str) : the starting year of the season
+        k (int) : number of rows
+    returns:
+        leaders (list) : [{"name": ..., "team": ..., metric: ...}, ...], best first
+    """
+    values = table[metric]
+    rows = np.flatnonzero((table["season"] == season) & ~np.isnan(values))
+    top = rows[np.argsort(-values[rows], kind="stable")[:k]]
+    return [
+        {"name": table["name"][row], "team": table["team"][row], metric: float(values[row])}
+        for row in top
+    ]
+
+
+def plot_metric(
+    indexes: Dict[str, Dict[str, Dict[str, dict]]],
+    metric: str,
+    season: str = "2021",
+    teams: List[str] = None,
+    names: Dict[str, str] = None,
+) -> None:
+    """Plot the top 3 players of every team by a metric with plot_best.
+
+    arguments:
+        indexes (dict) : {player url: {season: {team: stats}}}
+        metric (str) : a column or registered metric
+        season (str) : the starting year of the season
+        teams (list) : optional full or short team names to keep
+        names (dict) : optional {player url: name}
+    """
+    from fetch_player_statistics import plot_best
+
+    table = StatsTable.from_indexes(indexes, names)
+    plot_best(rank(table, metric, season, teams), stat=metric)
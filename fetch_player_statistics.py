@@ -1,14 +1,27 @@
 from binascii import a2b_base64
+import json
 import os
 import re
+import sys
 from operator import itemgetter
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 from urllib.parse import urljoin
 
 import numpy as np
 from bs4 import BeautifulSoup
+from checkpoint_journal import CheckpointJournal
 from matplotlib import pyplot as plt
-from requesting_urls import get_html
+from profiling import Profiler, clear_profiles, merge_profiles, stage
+from requesting_urls import (
+    FetchError,
+    failures,
+    free_soup,
+    get_html,
+    get_revision_ids,
+    get_sections_html,
+    use_memory_budget,
+    use_snapshot_archive,
+)
 from pathlib import Path
 
 
@@ -23,9 +36,43 @@ else:
 
 base_url = "https://en.wikipedia.org"
 
-
-
-def find_best_players(url: str) -> None:
+# matches team season link titles like '2021-22 Milwaukee Bucks season'
+season_title_pattern = re.compile(r"^(\d{4})\S*\s+(.+?)\s+season$")
+
+# marks for league leaders, champion seasons etc. next to stats
+footnote_marks = "*\u2020\u2021\n"
+
+# career table column headers: stats key
+stats_columns = {
+    "GP": "games",
+    "GS": "games_started",
+    "MPG": "minutes",
+    "FG%": "fg_pct",
+    "3P%": "three_pct",
+    "FT%": "ft_pct",
+    "RPG": "rebounds",
+    "APG": "assists",
+    "SPG": "steals",
+    "BPG": "blocks",
+    "PPG": "points",
+}
+# columns of the career table of a modern player, if the header can't be read
+default_stats_header = [
+    "Year", "Team", "GP", "GS", "MPG", "FG%", "3P%", "FT%", "RPG", "APG", "SPG", "BPG", "PPG",
+]
+
+# parsed-result store: {player url: {season: {team: stats}}}
+_stats_index = {}
+
+
+
+def find_best_players(
+    url: str,
+    index_path: str = None,
+    use_api: bool = False,
+    journal_path: str = None,
+    memory_budget: int = None,
+) -> None:
     """Find the best players in the semifinals of the nba.
 
     This is the top 3 scorers from every team in semifinals.
@@ -33,26 +80,169 @@ def find_best_players(url: str) -> None:
 
     arguments:
         - html (str) : html string from wiki basketball
+        - index_path (str) : optional json file with parsed player stats,
+            loaded before and saved after the run
+        - use_api (bool) : fetch only the needed sections of many pages per
+            request through the MediaWiki API instead of every full page
+        - journal_path (str) : optional checkpoint journal, finished teams and
+            players are recorded in it, and skipped when the run is restarted.
+            It is deleted when the run finishes.
+        - memory_budget (int) : run in low-memory mode, with this budget in bytes
+            for the resident memory of the process, see stream_best_players.
+            Can't be combined with use_api or journal_path.
     returns:
         - None
     """
+    if index_path:
+        load_stats_index(index_path)
+
+    if memory_budget:
+        if use_api or journal_path:
+            raise ValueError("low-memory mode can't be combined with use_api or journal_path")
+        use_memory_budget(memory_budget)
+        try:
+            best = dict(stream_best_players(url))
+        finally:
+            use_memory_budget(None)
+    else:
+        journal = None
+        done = {}
+        if journal_path:
+            journal = CheckpointJournal(journal_path)
+            done = journal.replay()
+            _stats_index.update(done.get("stats", {}))
+
+        try:
+            all_players = collect_players(url, use_api, journal, done)
+        finally:
+            if journal:
+                journal.close()
+
+        # Select top 3 for each team by points:
+        best = {}
+        for team, players in all_players.items():
+            best[team] = select_top_3(players)
+
+    if index_path:
+        save_stats_index(index_path)
+
+    stats_to_plot = ["points", "assists", "rebounds"]
+    for stat in stats_to_plot:
+        plot_best(best, stat=stat)
+
+    # Only crashed runs are resumed, the next run starts from scratch
+    if journal_path:
+        CheckpointJournal(journal_path).finish()
+
+    report_failures()
+
+
+def collect_players(
+    url: str,
+    use_api: bool = False,
+    journal: CheckpointJournal = None,
+    done: Dict[str, dict] = None,
+    refresh: bool = False,
+) -> Dict[str, List[Dict]]:
+    """Gets the players of every team in the semifinals, with their stats
+
+    Work found in done (replayed from the journal) is skipped,
+    and newly finished work is recorded in the journal.
+
+    arguments:
+        - url (str) : url of the nba playoffs wikipedia page
+        - use_api (bool) : fetch through the MediaWiki API, see find_best_players
+        - journal (CheckpointJournal) : optional journal to record finished work in
+        - done (dict) : work replayed from the journal
+        - refresh (bool) : fetch every full page fresh, bypassing caches and
+            the parsed-result store
+    returns:
+        - all_players (dict) : {team name: [player dicts]}, every player has
+            the keys name, url, points, assists and rebounds
+    """
+    done = done or {}
     # gets the teams
-    teams = get_teams(url)
+    teams = done.get("teams", {}).get(url)
+    if teams is None:
+        html = ""
+        if use_api:
+            try:
+                html = get_sections_html([url], ["Bracket"])[url]
+            except FetchError as e:
+                # falls back to the full page
+                print(e)
+        if html:
+            with stage("parse", url):
+                teams = parse_teams(html)
+        else:
+            teams = get_teams(url, refresh)
+        if journal:
+            journal.record("teams", url, teams)
+            journal.flush()
     assert len(teams) == 8
 
     # Gets the player for every team and stores in dict (get_players)
     all_players = {}
+    done_players = done.get("players", {})
+    todo = [item for item in teams if item["name"] not in done_players]
     for item in teams:
-        temp = []
-        for key in item:
-            temp.append(item[key])
-        all_players[temp[0]] = get_players(temp[1])
+        if item["name"] in done_players:
+            all_players[item["name"]] = done_players[item["name"]]
+    if use_api and todo:
+        try:
+            pages = get_sections_html([item["url"] for item in todo], ["Roster"])
+        except FetchError as e:
+            print(e)
+            pages = {}
+        for item in todo:
+            # Pages without a roster section are fetched in full below
+            if not pages.get(item["url"]):
+                continue
+            with stage("parse", item["url"]):
+                all_players[item["name"]] = parse_players(pages[item["url"]])
+            if journal:
+                journal.record("players", item["name"], all_players[item["name"]])
+        todo = [item for item in todo if item["name"] not in all_players]
+    if todo:
+        for item in todo:
+            temp = []
+            for key in item:
+                temp.append(item[key])
+            try:
+                all_players[temp[0]] = get_players(temp[1], refresh)
+            except FetchError as e:
+                # Leave the team without players instead of aborting the run
+                print(e)
+                all_players[temp[0]] = []
+                continue
+            if journal:
+                journal.record("players", temp[0], all_players[temp[0]])
+
+    def record_stats(player_urls):
+        if journal:
+            for player_url in player_urls:
+                journal.record("stats", player_url, _stats_index[player_url])
+
+    # Fill the parsed-result store with all players in a few batched requests
+    if use_api:
+        player_urls = [p["url"] for players in all_players.values() for p in players]
+        missing = [player_url for player_url in player_urls if player_url not in _stats_index]
+        prefetch_player_stats(missing)
+        record_stats(player_url for player_url in missing if player_url in _stats_index)
 
     # get player statistics for each player,
     # using get_player_stats
     for team, players in all_players.items():
         for p in players:
-            temp = (get_player_stats(p["url"], team))
+            is_new = refresh or p["url"] not in _stats_index
+            try:
+                temp = lookup_stats(get_player_stats_index(p["url"], refresh=refresh), "2021", team)
+            except FetchError as e:
+                print(e)
+                temp = {}
+            else:
+                if is_new:
+                    record_stats([p["url"]])
             if temp:
                 p["points"] = temp["points"]
                 p["assists"] = temp["assists"]
@@ -62,35 +252,219 @@ def find_best_players(url: str) -> None:
                 p["assists"] = 0.0
                 p["rebounds"] = 0.0
 
-    # Select top 3 for each team by points:
-    best = {}
-    for team, players in all_players.items():
-        top_3 = []
+    return all_players
+
+
+def stream_best_players(url: str, season: str = "2021") -> Iterator[Tuple[str, List[Dict]]]:
+    """Yields the top 3 players of every team in the semifinals, one team at a time
+
+    Memory stays bounded by a single team: its players are dropped once its
+    top 3 is yielded, and parsed player stats are not kept in the
+    parsed-result store (stats already in it are still used).
+
+    arguments:
+        - url (str) : url of the nba playoffs wikipedia page
+        - season (str) : the starting year of the season
+    yields:
+        - (team name, top 3) : see select_top_3, a team whose page could not
+            be fetched has no players
+    """
+    teams = get_teams(url)
+    assert len(teams) == 8
+
+    for item in teams:
+        team = item["name"]
+        try:
+            players = get_players(item["url"])
+        except FetchError as e:
+            print(e)
+            yield team, []
+            continue
         for p in players:
-            if len(top_3) != 3:
-                top_3.append({
-                    "name": p["name"],
-                    "points": p["points"],
-                    "assists": p["assists"],
-                    "rebounds": p["rebounds"]
-                })
+            try:
+                stats = lookup_stats(get_player_stats_index(p["url"], store=False), season, team)
+            except FetchError as e:
+                print(e)
+                stats = {}
+            for key in ("points", "assists", "rebounds"):
+                p[key] = stats.get(key, 0.0)
+        yield team, select_top_3(players)
+
+
+def report_failures() -> None:
+    """Prints the urls that could not be fetched during the run"""
+    if not failures:
+        return
+    print(f"Could not fetch {len(failures)} pages:")
+    for failed_url, reason in failures.items():
+        print(f"  {failed_url}: {reason}")
+
+
+def refresh_best_players(url: str, state_path: str = "refresh_state.json") -> None:
+    """Incrementally redo find_best_players, only re-fetching changed pages.
+
+    The revision ids of all known pages are looked up in a few batched
+    MediaWiki API requests. Only pages with a new revision are fetched and
+    parsed again, only teams with changed pages get a new top 3, and only the
+    plots of stats whose top 3 changed are drawn again.
+    The first run (without a state file) is a full run.
+    Pages that can't be fetched keep their previous results, and are
+    fetched again on the next run.
+
+    arguments:
+        - url (str) : url of the nba playoffs wikipedia page
+        - state_path (str) : json file keeping revisions and results between runs
+    returns:
+        - None
+    """
+    state = {"revisions": {}, "teams": [], "players": {}, "stats": {}, "best": {}}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state.update(json.load(f))
+    _stats_index.update(state["stats"])
+
+    known = [url] + [t["url"] for t in state["teams"]]
+    for players in state["players"].values():
+        known.extend(p["url"] for p in players)
+    latest = get_revision_ids(known)
+
+    def is_changed(page_url):
+        return page_url not in latest or latest[page_url] != state["revisions"].get(page_url)
+
+    fetched = []
+    teams = state["teams"]
+    if not teams or is_changed(url):
+        try:
+            html = get_html(url, refresh=True)
+        except FetchError as e:
+            # Without earlier teams there is nothing to refresh
+            if not teams:
+                raise
+            print(e)
+            latest.pop(url, None)
+        else:
+            with stage("parse", url):
+                teams = parse_teams(html)
+            fetched.append(url)
+    assert len(teams) == 8
+
+    affected = set()
+    all_players = {}
+    for item in teams:
+        team, team_url = item["name"], item["url"]
+        players = state["players"].get(team)
+        if players is None or team_url != _team_url(state["teams"], team) or is_changed(team_url):
+            print(f"Finding players in {team_url}")
+            try:
+                html = get_html(team_url, refresh=True)
+            except FetchError as e:
+                # Keep the old roster, and try again on the next run
+                print(e)
+                latest.pop(team_url, None)
+                players = state["players"].get(team, [])
             else:
-                # Sorts the top 3 so that the worst out of the 3 is first in the list.
-                top_3 = sorted(top_3, key=lambda d: d["points"])
-                if p["points"] > top_3[0]["points"]:
-                    top_3[0]["name"] = p["name"]
-                    top_3[0]["points"] = p["points"]
-                    top_3[0]["assists"] = p["assists"]
-                    top_3[0]["rebounds"] = p["rebounds"]
-        best[team] = top_3
+                with stage("parse", team_url):
+                    players = parse_players(html)
+                fetched.append(team_url)
+                affected.add(team)
+        for p in players:
+            if p["url"] not in _stats_index or is_changed(p["url"]):
+                print(f"Fetching stats for player in {p['url']}")
+                try:
+                    html = get_html(p["url"], refresh=True)
+                except FetchError as e:
+                    # Keep the old stats, and try again on the next run
+                    print(e)
+                    latest.pop(p["url"], None)
+                    continue
+                with stage("parse", p["url"]):
+                    _stats_index[p["url"]] = parse_player_page(html)
+                fetched.append(p["url"])
+                affected.add(team)
+        all_players[team] = players
+
+    best = {team: top_3 for team, top_3 in state["best"].items() if team in all_players}
+    for team in all_players.keys() - best.keys():
+        affected.add(team)
+    for team in affected:
+        players = [dict(p) for p in all_players[team]]
+        for p in players:
+            # Players whose page failed have no (new) stats, don't fetch them again here
+            stats = lookup_stats(_stats_index.get(p["url"], {}), "2021", team)
+            for key in ("points", "assists", "rebounds"):
+                p[key] = stats.get(key, 0.0)
+        best[team] = select_top_3(players)
 
     stats_to_plot = ["points", "assists", "rebounds"]
     for stat in stats_to_plot:
-        plot_best(best, stat=stat)
+        filename = os.path.join("results_graphs", f"{stat}.png")
+        if _top_3_changed(state["best"], best, stat) or not os.path.exists(filename):
+            plot_best(best, stat=stat)
+
+    # Remember the revisions of the pages that were fetched for the first time
+    missing = [page_url for page_url in fetched if page_url not in latest]
+    if missing:
+        latest.update(get_revision_ids(missing))
+    state["revisions"].update(latest)
+    state["teams"] = teams
+    state["players"] = all_players
+    state["stats"] = _stats_index
+    state["best"] = best
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+
+    report_failures()
+
+
+def _team_url(teams: List[Dict], team: str) -> str:
+    """Finds the url of a team in a list of team dicts"""
+    for item in teams:
+        if item["name"] == team:
+            return item["url"]
+    return None
+
 
+def _top_3_changed(old: Dict[str, List[Dict]], new: Dict[str, List[Dict]], stat: str) -> bool:
+    """Checks if a plot of stat would differ between two results of select_top_3"""
+    if old.keys() != new.keys():
+        return True
+    for team, players in new.items():
+        before = sorted((p["name"], p[stat]) for p in old[team])
+        after = sorted((p["name"], p[stat]) for p in players)
+        if before != after:
+            return True
+    return False
 
 
-def plot_best(best: Dict[str, List[Dict]], stat: str) -> None:
+def select_top_3(players: List[Dict]) -> List[Dict]:
+    """Selects the top 3 players of a team by points
+
+    arguments:
+        players (list) : player dicts with name, points, assists and rebounds
+    returns:
+        top_3 (list) : the (at most) 3 best players
+    """
+    top_3 = []
+    for p in players:
+        if len(top_3) != 3:
+            top_3.append({
+                "name": p["name"],
+                "points": p["points"],
+                "assists": p["assists"],
+                "rebounds": p["rebounds"]
+            })
+        else:
+            # Sorts the top 3 so that the worst out of the 3 is first in the list.
+            top_3 = sorted(top_3, key=lambda d: d["points"])
+            if p["points"] > top_3[0]["points"]:
+                top_3[0]["name"] = p["name"]
+                top_3[0]["points"] = p["points"]
+                top_3[0]["assists"] = p["assists"]
+                top_3[0]["rebounds"] = p["rebounds"]
+    return top_3
+
+
+def plot_best(best: Dict[str, List[Dict]], stat: str, stats_dir: str = "results_graphs") -> None:
     """Plots a single stat for the top 3 players from every team.
 
     Arguments:
@@ -114,56 +488,72 @@ def plot_best(best: Dict[str, List[Dict]], stat: str) -> None:
 
         stat (str) : [points | assists | rebounds] which stat to plot.
             Should be a key in the player info dictionary.
+
+        stats_dir (str) : directory to store the plot in.
     """
-    stats_dir = "results_graphs"
     # Make new directory.
     current_dir = os.getcwd()
     final_dir = os.path.join(current_dir, stats_dir)
     if not os.path.exists(final_dir):
         os.makedirs(final_dir)
 
-    # Clears plot so old doesn't overlap with new
-    plt.clf()
-    colors = ["red", "green", "purple"]
-    counter = 0
-    all_teams = []
-
-    for team, players in best.items():
-        # Sorts player from best stat to worst.
-        players = sorted(players, key=lambda d: d[stat], reverse=True)
-        all_teams.extend(["", team, "", ""])
-        # Gets player names and stats
-        stats = []
-        names = []
-        for p in players:
-            stats.append(p[stat])
-            names.append(p["name"])
-        # Adds the bars for the stats
-        for i in range(len(players)):
-            plt.bar(counter+i, stats[i], 1, color=colors[i], label=names[i])
-            plt.text(counter+i-0.4, 0, names[i], rotation=90)
-        counter += len(players)+1
-
-    plt.xticks(range(len(all_teams)), all_teams, rotation=90)
-    plt.title(f"{stat} per game for top 3 players in all teams")
-    filename = f"{stats_dir}/{stat}.png"
-    print(f"Creating {filename}")
-    plt.tight_layout()
-    plt.savefig(filename)
+    with stage("render", stat):
+        # Clears plot so old doesn't overlap with new
+        plt.clf()
+        colors = ["red", "green", "purple"]
+        counter = 0
+        all_teams = []
+
+        for team, players in best.items():
+            # Sorts player from best stat to worst.
+            players = sorted(players, key=lambda d: d[stat], reverse=True)
+            all_teams.extend(["", team, "", ""])
+            # Gets player names and stats
+            stats = []
+            names = []
+            for p in players:
+                stats.append(p[stat])
+                names.append(p["name"])
+            # Adds the bars for the stats
+            for i in range(len(players)):
+                plt.bar(counter+i, stats[i], 1, color=colors[i], label=names[i])
+                plt.text(counter+i-0.4, 0, names[i], rotation=90)
+            counter += len(players)+1
+
+        plt.xticks(range(len(all_teams)), all_teams, rotation=90)
+        per_game = " per game" if stat in ("points", "assists", "rebounds") else ""
+        plt.title(f"{stat}{per_game} for top 3 players in all teams")
+        filename = f"{stats_dir}/{stat}.png"
+        print(f"Creating {filename}")
+        plt.tight_layout()
+        plt.savefig(filename)
         
 
 
-def get_teams(url: str) -> list:
+def get_teams(url: str, refresh: bool = False) -> list:
     """Extracts all the teams that were in the semi finals in nba
 
     arguments:
         - url (str) : url of the nba finals wikipedia page
+        - refresh (bool) : fetch the page fresh, bypassing caches
     returns:
         teams (list) : list with all teams
             Each team is a dictionary of {'name': team name, 'url': team page
     """
+    html = get_html(url, refresh=refresh)
+    with stage("parse", url):
+        return parse_teams(html)
+
+
+def parse_teams(html: str) -> list:
+    """Extracts the teams in the semi finals from the html of the playoffs page
+
+    arguments:
+        - html (str) : html of the nba playoffs wikipedia page
+    returns:
+        teams (list) : list with all teams, see get_teams
+    """
     # Get the table
-    html = get_html(url)
     soup = BeautifulSoup(html, "html.parser")
     table = soup.find(id="Bracket").find_next("table")
 
@@ -214,6 +604,8 @@ def get_teams(url: str) -> list:
     #     }
     # ]
 
+    free_soup(soup)
+
     assert len(in_semifinal) == 8
     return [
         {
@@ -225,18 +617,31 @@ def get_teams(url: str) -> list:
 
 
 
-def get_players(team_url: str) -> list:
+def get_players(team_url: str, refresh: bool = False) -> list:
     """Gets all the players from a team that were in the roster for semi finals
     arguments:
         team_url (str) : the url for the team
+        refresh (bool) : fetch the page fresh, bypassing caches
     returns:
         player_infos (list) : list of player info dictionaries
             with form: {'name': player name, 'url': player wikipedia page url}
     """
     print(f"Finding players in {team_url}")
 
+    html = get_html(team_url, refresh=refresh)
+    with stage("parse", team_url):
+        return parse_players(html)
+
+
+def parse_players(html: str) -> list:
+    """Extracts the roster from the html of a team season page
+
+    arguments:
+        html (str) : html of the team wikipedia page
+    returns:
+        player_infos (list) : list of player info dictionaries, see get_players
+    """
     # Get the table
-    html = get_html(team_url)
     soup = BeautifulSoup(html, "html.parser")
     roster = soup.find(id="Roster")
     table = roster.find_next("table")
@@ -260,77 +665,248 @@ def get_players(team_url: str) -> list:
 
         players.append({"name": name, "url": f"{base_url}{url}"})
 
+    free_soup(soup)
     # return list of players
     return players
 
 
-def get_player_stats(player_url: str, team: str) -> dict:
+def get_player_stats(player_url: str, team: str, season: str = "2021") -> dict:
     """Gets the player stats for a player in a given team
     arguments:
         player_url (str) : url for the wiki page of player
         team (str) : the name of the team the player plays for
+        season (str) : the starting year of the season (e.g. '2021' for 2021-22)
     returns:
         stats (dict) : dictionary with the keys (at least): points, assists, and rebounds keys
     """
+    index = get_player_stats_index(player_url)
+    return lookup_stats(index, season, team)
+
+
+def get_player_stats_index(
+    player_url: str,
+    store: bool = True,
+    refresh: bool = False,
+) -> Dict[str, Dict[str, dict]]:
+    """Gets the (season, team) index of a player's career table
+
+    The career table is only fetched and parsed the first time a player is seen,
+    later calls are answered from the parsed-result store.
+
+    arguments:
+        player_url (str) : url for the wiki page of player
+        store (bool) : keep the index in the parsed-result store
+        refresh (bool) : fetch the page fresh, bypassing caches and the store
+    returns:
+        index (dict) : {season: {team: stats}}, see parse_stats_table
+    """
+    if player_url in _stats_index and not refresh:
+        return _stats_index[player_url]
+
     print(f"Fetching stats for player in {player_url}")
 
+    html = get_html(player_url, refresh=refresh)
+    with stage("parse", player_url):
+        index = parse_player_page(html)
+    if store:
+        _stats_index[player_url] = index
+    return index
+
+
+def prefetch_player_stats(player_urls: List[str]) -> None:
+    """Fills the parsed-result store for many players through the MediaWiki API
+
+    Only the career stats sections are fetched, many players per request.
+    Players already in the store are skipped.
+
+    arguments:
+        player_urls (list) : urls for the wiki pages of players
+    """
+    missing = [url for url in dict.fromkeys(player_urls) if url not in _stats_index]
+    if not missing:
+        return
+    print(f"Fetching stats for {len(missing)} players through the MediaWiki API")
+    try:
+        pages = get_sections_html(missing, ["Regular season", "NBA"])
+    except FetchError as e:
+        # get_player_stats falls back to fetching the full pages one by one
+        print(e)
+        return
+    for url, html in pages.items():
+        # Pages without the sections are left to get_player_stats
+        if not html:
+            continue
+        with stage("parse", url):
+            _stats_index[url] = parse_player_page(html)
+
+
+def parse_player_page(html: str) -> Dict[str, Dict[str, dict]]:
+    """Builds the (season, team) stats index from the html of a player page
+
+    arguments:
+        html (str) : html of the player wikipedia page
+    returns:
+        index (dict) : {season: {team: stats}}, see parse_stats_table
+    """
     # Get the table with stats
-    html = get_html(player_url)
     soup = BeautifulSoup(html, "html.parser")
-    if soup.find(id="Regular_season"):
-        nba = soup.find(id="Regular_season")
-    elif soup.find(id="NBA"):
-        nba = soup.find(id="NBA")
-    table = nba.find_next("table")
-
-    # Normally these are the indices for the wanted stats.
-    ppg_index = 12
-    apg_index = 9
-    rpg_index = 8
-
-    stats = {}
+    nba = soup.find(id="Regular_season") or soup.find(id="NBA")
+    index = parse_stats_table(nba.find_next("table")) if nba else {}
+    free_soup(soup)
+    return index
+
+
+def parse_stats_table(table) -> Dict[str, Dict[str, dict]]:
+    """Builds a (season, team) index over the rows of a career stats table
+
+    Players traded within a season share a year cell spanning several rows
+    (rowspan), so those rows start directly with the team column.
+
+    arguments:
+        table (bs4.Tag) : the regular season table from a player page
+    returns:
+        index (dict) : {season: {team: stats}}, where season is the starting year
+            (e.g. '2021'), team is the full team name (e.g. 'Milwaukee Bucks')
+            and stats has the keys points, assists and rebounds, and the other
+            columns of the table found in stats_columns
+    """
+    index = {}
     rows = table.find_all("tr")
+
+    # The stats columns are read from the header, old seasons lack some
+    # (e.g. 3P%, SPG and BPG), and counted from the end of the row,
+    # so colspans in the first columns don't move them.
+    header = [th.get_text(strip=True).strip(footnote_marks) for th in rows[0].find_all("th")]
+    if "PPG" not in header:
+        header = default_stats_header
+    columns = {
+        stats_columns[name]: position - len(header)
+        for position, name in enumerate(header)
+        if name in stats_columns
+    }
+
     rows = rows[1:]
-    # Loop over rows and extract the stats
-    index = 1
+    # Rows left that are covered by the year cell of an earlier row
     rowspan = 0
     for row in rows:
         cols = row.find_all("td")
-        # Some fixes if there are fewer columns than expected because of a colspan.
-        if len(cols) < 13:
-            ppg_index = ppg_index - (13 - len(cols))
-            apg_index = apg_index - (13 - len(cols))
-            rpg_index = rpg_index - (13 - len(cols))
-
-        if not cols[index].find("a"):
-            break
-
-        title = cols[index].find("a").attrs["title"]
+        if len(cols) < 2:
+            continue
 
-        # Check correct team (some players change team within season)
-        if cols[0].has_attr("rowspan"):
-            index = 0
+        if rowspan > 0:
+            team_col = cols[0]
+            rowspan -= 1
         else:
-            index = 1
+            team_col = cols[1]
+            if cols[0].has_attr("rowspan"):
+                rowspan = int(cols[0]["rowspan"]) - 1
+
+        # Rows without a team season link are totals (Career, All-Star)
+        a = team_col.find("a")
+        if not a or not a.has_attr("title"):
+            continue
+        match = season_title_pattern.match(a["title"])
+        if not match:
+            continue
+        season, team_name = match.groups()
 
         try:
-            if "2021" in title and team in title:
-                # load stats from columns
-                # keys should be 'points', 'assists', etc.
-                stats = {
-                    "points": float(cols[ppg_index].text.strip("*\n")),
-                    "assists": float(cols[apg_index].text.strip("*")),
-                    "rebounds": float(cols[rpg_index].text.strip("*"))
-                }
-                break
+            stats = {
+                "points": float(cols[columns["points"]].text.strip(footnote_marks)),
+                "assists": float(cols[columns["assists"]].text.strip(footnote_marks)),
+                "rebounds": float(cols[columns["rebounds"]].text.strip(footnote_marks)),
+            }
         except ValueError as e:
             print(f"ValueError: {e}")
-            
+            continue
+        # The other columns are optional, they are often empty (a dash)
+        for key, position in columns.items():
+            if key not in stats and -position <= len(cols):
+                try:
+                    stats[key] = float(cols[position].text.strip(footnote_marks))
+                except ValueError:
+                    pass
+        index.setdefault(season, {})[team_name] = stats
+
+    return index
+
 
-    return stats
+def lookup_stats(index: Dict[str, Dict[str, dict]], season: str, team: str) -> dict:
+    """Looks up the stats for a season and team in a player stats index
+
+    arguments:
+        index (dict) : {season: {team: stats}} from get_player_stats_index
+        season (str) : the starting year of the season
+        team (str) : full or short team name (e.g. 'Golden State')
+    returns:
+        stats (dict) : the stats, or an empty dict if not found
+    """
+    teams = index.get(season, {})
+    if team in teams:
+        return teams[team]
+    # A season holds at most a few teams, so matching short names is cheap
+    for team_name, stats in teams.items():
+        if team in team_name:
+            return stats
+    return {}
+
+
+def load_stats_index(path: str) -> None:
+    """Loads a previously saved parsed-result store
+
+    arguments:
+        path (str) : json file written by save_stats_index
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            _stats_index.update(json.load(f))
+
+
+def save_stats_index(path: str) -> None:
+    """Saves the parsed-result store so it can be reused by later runs
+
+    arguments:
+        path (str) : json file to write
+    """
+    with open(path, "w") as f:
+        json.dump(_stats_index, f)
 
 
 # run the whole thing if called as a script, for quick testing
 if __name__ == "__main__":
     url = "https://en.wikipedia.org/wiki/2022_NBA_playoffs"
-    find_best_players(url)
+    if "--archive" in sys.argv:
+        # The archive replaces requests_cache for full pages
+        if "requests_cache" in sys.modules:
+            requests_cache.uninstall_cache()
+        use_snapshot_archive("snapshots")
+    # --low-memory uses a budget of 512 MB, --low-memory=<MB> another one
+    memory_budget = None
+    # --index keeps the parsed player stats in player_stats.json, --index=<path> elsewhere
+    index_path = None
+    for arg in sys.argv:
+        if arg.startswith("--low-memory"):
+            memory_budget = int(arg.partition("=")[2] or 512) * 1024 * 1024
+        if arg.startswith("--index"):
+            index_path = arg.partition("=")[2] or "player_stats.json"
+    profiler = None
+    if "--profile" in sys.argv:
+        clear_profiles("profile")
+        profiler = Profiler("profile")
+        profiler.start()
+    try:
+        if "--refresh" in sys.argv:
+            refresh_best_players(url)
+        else:
+            journal_path = "best_players.journal" if "--checkpoint" in sys.argv else None
+            find_best_players(
+                url,
+                index_path=index_path,
+                use_api="--api" in sys.argv,
+                journal_path=journal_path,
+                memory_budget=memory_budget,
+            )
+    finally:
+        if profiler:
+            profiler.stop()
+            print(merge_profiles("profile"))
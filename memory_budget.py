@@ -0,0 +1,147 @@
+import ctypes
+import ctypes.util
+import gc
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from typing import Callable, Dict, Union
+
+megabyte = 1024 * 1024
+
+
+def current_rss() -> int:
+    """Resident memory of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No /proc (e.g. macOS), the peak is the best there is
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """Highest resident memory of this process so far, in bytes."""
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _load_malloc_trim():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim
+    except (OSError, AttributeError, TypeError):
+        # not glibc
+        return None
+
+
+_malloc_trim = _load_malloc_trim()
+
+
+def release_memory() -> None:
+    """Free unreachable objects now, and give freed heap memory back to the OS."""
+    gc.collect()
+    if _malloc_trim is not None:
+        _malloc_trim(0)
+
+
+class MemoryBudget:
+    """Checks the memory of the process against a limit before every fetch.
+
+    check() is called before every fetch (see requesting_urls.use_memory_budget).
+    Under the limit it returns at once. Over it, garbage is collected and freed
+    memory is given back to the OS. Pages are fetched one at a time, so there
+    is nothing else to wait for: if the process is still over the limit the
+    fetch goes ahead anyway, and is counted in overruns with a warning printed
+    the first time. What keeps the memory bounded is stream_best_players,
+    ranking one team at a time and freeing every parse tree right after use.
+    """
+
+    def __init__(self, limit: int, measure: Callable[[], int] = current_rss):
+        self.limit = limit
+        self.measure = measure
+        self.lock = threading.Lock()
+        self.peak = 0
+        self.releases = 0
+        self.overruns = 0
+
+    def check(self) -> None:
+        """Give freed memory back to the OS if the process is over the limit."""
+        if self._measure() <= self.limit:
+            return
+        release_memory()
+        rss = self._measure()
+        with self.lock:
+            self.releases += 1
+            if rss <= self.limit:
+                return
+            self.overruns += 1
+            first = self.overruns == 1
+        if first:
+            print(
+                f"Memory use {rss // megabyte} MB is over the budget "
+                f"of {self.limit // megabyte} MB"
+            )
+
+    def _measure(self) -> int:
+        rss = self.measure()
+        with self.lock:
+            self.peak = max(self.peak, rss)
+        return rss
+
+
+def _measure_run(url: str, memory_budget: int, results) -> None:
+    from fetch_player_statistics import find_best_players
+
+    find_best_players(url, memory_budget=memory_budget)
+    results.put(peak_rss())
+
+
+def benchmark(url: str, memory_budget: int = 256 * megabyte) -> Dict[str, Union[float, bool]]:
+    """Peak memory of find_best_players with and without a memory budget.
+
+    Every run starts in a fresh process, so the peaks don't include each other.
+    This needs the network, tests/test_fetch_player_statistics.py checks the
+    bound offline with tracemalloc instead.
+
+    arguments:
+        url (str) : url of the nba playoffs wikipedia page
+        memory_budget (int) : the budget in bytes for the low-memory run
+    returns:
+        peaks (dict) : {'default': MB, 'low_memory': MB, 'budget': MB,
+            'within_budget': whether the low-memory peak is at most the budget
+            and below the default peak}
+    raises:
+        RuntimeError : if a run exits without reporting its peak
+    """
+    peaks = {}
+    for name, budget in [("default", None), ("low_memory", memory_budget)]:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure_run, args=(url, budget, results))
+        process.start()
+        peak = None
+        while peak is None:
+            try:
+                peak = results.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive() and results.empty():
+                    break
+        process.join()
+        if peak is None:
+            raise RuntimeError(f"The {name} run failed with exit code {process.exitcode}")
+        peaks[name] = peak / megabyte
+    peaks["budget"] = memory_budget / megabyte
+    peaks["within_budget"] = peaks["low_memory"] <= peaks["budget"] and peaks["low_memory"] < peaks["default"]
+    return peaks
+
+
+if __name__ == "__main__":
+    # python memory_budget.py [budget in MB]
+    budget = int(sys.argv[1]) * megabyte if len(sys.argv) > 1 else 256 * megabyte
+    peaks = benchmark("https://en.wikipedia.org/wiki/2022_NBA_playoffs", budget)
+    print(json.dumps(peaks, indent=4))
+    sys.exit(0 if peaks["within_budget"] else 1)
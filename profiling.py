@@ -0,0 +1,288 @@
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict
+
+# the profiler running in this process, if any
+_active = None
+
+
+@contextmanager
+def stage(name: str, url: str = None):
+    """Attribute the time spent in a block to a stage and url.
+
+    Stages are e.g. 'network', 'parse' and 'render'. This costs next to
+    nothing when no Profiler is running.
+
+    arguments:
+        name (str) : the stage
+        url (str) : what the stage works on, e.g. the url being fetched
+    """
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    stages = profiler.thread_stages.setdefault(threading.get_ident(), [])
+    stages.append(name)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - start
+        stages.pop()
+        profiler.record_stage(name, url, seconds)
+
+
+class Profiler:
+    """Profiles the scraping code in this process.
+
+    It collects three things:
+        - a cProfile of every function, in every thread
+        - stacks of all threads sampled every `interval` seconds, labelled with
+          the thread and the current stage, saved as collapsed stacks that
+          flamegraph.pl, speedscope or inferno can draw
+        - time per stage and url, see stage()
+
+    Files written to output_dir when stopped (one set per process, so worker
+    processes can profile into the same directory, see merge_profiles):
+        cpu.<pid>.prof : the cProfile stats, readable with pstats or snakeviz
+        stacks.<pid>.folded : the sampled stacks
+        stages.<pid>.json : {stage: {url: [calls, seconds]}}
+    Files of earlier runs are left alone, see clear_profiles.
+
+    Example:
+        with Profiler("profile") as profiler:
+            find_best_players(url)
+        print(profiler.report())
+    """
+
+    def __init__(self, output_dir: str = "profile", interval: float = 0.005):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.profiles = []
+        self.profiles_lock = threading.Lock()
+        self.stacks = Counter()
+        self.stages = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+        self.stages_lock = threading.Lock()
+        self.thread_stages = {}
+        self.stop_sampling = threading.Event()
+        self.sampler = None
+
+    def start(self) -> None:
+        global _active
+        if _active is not None:
+            raise RuntimeError("a profiler is already running in this process")
+        _active = self
+        # Threads started from now on get their own cProfile
+        threading.setprofile(self._start_thread_profile)
+        self._add_profile().enable()
+        self.stop_sampling.clear()
+        self.sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+        self.sampler.start()
+
+    def stop(self) -> None:
+        global _active
+        # The profile of this thread first, disable() only works on the current thread
+        self.profiles[0].disable()
+        threading.setprofile(None)
+        self.stop_sampling.set()
+        self.sampler.join()
+        _active = None
+        self.save()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record_stage(self, name: str, url: str, seconds: float) -> None:
+        with self.stages_lock:
+            entry = self.stages[name][url or ""]
+            entry[0] += 1
+            entry[1] += seconds
+
+    def save(self) -> None:
+        """Write the profiles of this process to output_dir."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        pid = os.getpid()
+        self.cpu_stats().dump_stats(os.path.join(self.output_dir, f"cpu.{pid}.prof"))
+        with open(os.path.join(self.output_dir, f"stacks.{pid}.folded"), "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(self.output_dir, f"stages.{pid}.json"), "w") as f:
+            json.dump(self.stages, f)
+
+    def cpu_stats(self) -> pstats.Stats:
+        """The cProfile stats of all threads together."""
+        with self.profiles_lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        return stats
+
+    def report(self, top: int = 20) -> str:
+        """A summary of the hot spots of this process, see summarize."""
+        return summarize(self.cpu_stats(), self.stacks, self.stages, top)
+
+    def _add_profile(self) -> cProfile.Profile:
+        profile = cProfile.Profile()
+        with self.profiles_lock:
+            self.profiles.append(profile)
+        return profile
+
+    def _start_thread_profile(self, frame, event, arg):
+        # Called once in every new thread, replaced by the thread's own cProfile
+        sys.setprofile(None)
+        if threading.current_thread() is self.sampler:
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one cProfile per process, the samples still cover the thread
+            return
+        with self.profiles_lock:
+            self.profiles.append(profile)
+
+    def _sample(self) -> None:
+        names = {}
+        own = threading.get_ident()
+        while not self.stop_sampling.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                # The thread pushes and pops its stages meanwhile
+                try:
+                    current = (self.thread_stages.get(ident) or ["other"])[-1]
+                except IndexError:
+                    current = "other"
+                calls.extend([f"stage:{current}", names.get(ident, str(ident))])
+                self.stacks[";".join(reversed(calls))] += 1
+
+
+def summarize(
+    stats: pstats.Stats,
+    stacks: Counter,
+    stages: Dict[str, Dict[str, list]],
+    top: int = 20,
+) -> str:
+    """Text summary: time per stage, slowest urls, and hottest functions.
+
+    arguments:
+        stats (pstats.Stats) : cProfile stats
+        stacks (Counter) : sampled collapsed stacks and their counts
+        stages (dict) : {stage: {url: [calls, seconds]}}
+        top (int) : number of urls and functions to list
+    returns:
+        summary (str)
+    """
+    lines = ["Time per stage:"]
+    for name, urls in sorted(stages.items()):
+        calls = sum(entry[0] for entry in urls.values())
+        seconds = sum(entry[1] for entry in urls.values())
+        lines.append(f"  {name:<10} {seconds:9.3f} s  in {calls} calls")
+
+    lines.append("Slowest urls:")
+    slowest = sorted(
+        ((entry[1], name, url) for name, urls in stages.items() for url, entry in urls.items() if url),
+        reverse=True,
+    )
+    for seconds, name, url in slowest[:top]:
+        lines.append(f"  {seconds:9.3f} s  {name:<10} {url}")
+
+    # Time a function is on top of the sampled stacks (self time), in all threads
+    samples = sum(stacks.values())
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    lines.append(f"Hottest functions in {samples} samples:")
+    for function, count in leaves.most_common(top):
+        lines.append(f"  {100 * count / max(samples, 1):5.1f} %  {function}")
+
+    lines.append("CPU profile, by cumulative time:")
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats("cumulative").print_stats(top)
+    lines.append(stream.getvalue())
+    return "\n".join(lines)
+
+
+def clear_profiles(output_dir: str) -> None:
+    """Remove the files of earlier runs from output_dir, so merge_profiles
+    only combines the run about to start."""
+    for pattern in ["cpu.*.prof", "stacks.*", "stages.*.json", "summary.txt"]:
+        for path in glob.glob(os.path.join(output_dir, pattern)):
+            os.remove(path)
+
+
+def merge_profiles(output_dir: str, top: int = 20) -> str:
+    """Combine the profiles of all processes in output_dir.
+
+    Writes stacks.folded and summary.txt for all of them together.
+
+    arguments:
+        output_dir (str) : directory the Profilers saved to
+        top (int) : number of urls and functions in the summary
+    returns:
+        summary (str)
+    """
+    prof_files = sorted(glob.glob(os.path.join(output_dir, "cpu.*.prof")))
+    stats = pstats.Stats(*prof_files, stream=io.StringIO())
+
+    stacks = Counter()
+    for path in glob.glob(os.path.join(output_dir, "stacks.*.folded")):
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                stacks[stack] += int(count)
+    with open(os.path.join(output_dir, "stacks.folded"), "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+    stages = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+    for path in glob.glob(os.path.join(output_dir, "stages.*.json")):
+        with open(path) as f:
+            for name, urls in json.load(f).items():
+                for url, (calls, seconds) in urls.items():
+                    stages[name][url][0] += calls
+                    stages[name][url][1] += seconds
+
+    summary = summarize(stats, stacks, stages, top)
+    with open(os.path.join(output_dir, "summary.txt"), "w") as f:
+        f.write(summary)
+    return summary
+
+
+def profile_call(func, *args, output_dir: str = "profile", **kwargs):
+    """Run func(*args, **kwargs) under a Profiler and write the summary.
+
+    returns:
+        the return value of func
+    """
+    clear_profiles(output_dir)
+    with Profiler(output_dir):
+        result = func(*args, **kwargs)
+    print(merge_profiles(output_dir))
+    return result
@@ -1,26 +1,507 @@
-from typing import Dict, Optional
+import atexit
+import random
+import re
+import threading
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep, time
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import unquote, urlparse
 
 import requests
+from bs4 import BeautifulSoup
+from memory_budget import MemoryBudget
+from profiling import stage
+from requests.adapters import HTTPAdapter
+from snapshot_archive import SnapshotArchive
 
+api_url = "https://en.wikipedia.org/w/api.php"
 
-def get_html(url: str):
+# responses worth retrying: throttling and temporary server errors
+retry_statuses = {429, 500, 502, 503, 504}
+# responses saying the whole host is in trouble, rather than one page
+host_statuses = {429, 503}
+# backoff before retry n is random between 0 and min(backoff_cap, backoff_base * 2**n)
+backoff_base = 0.5
+backoff_cap = 60.0
+
+# urls that could not be fetched in this process: {url: reason}
+failures = {}
+
+# optional SnapshotArchive get_html reads pages from and stores them in
+archive = None
+
+# optional MemoryBudget checked before every request
+memory_budget = None
+
+# matches wikitext headings like '=== Regular season ==='
+heading_pattern = re.compile(r"^(={2,6})\s*(.+?)\s*\1\s*$", flags=re.MULTILINE)
+
+
+def get_html(url: str, refresh: bool = False):
     """Get an HTML page and return its contents.
 
     Args:
         url (str):
             The URL to retrieve.
+        refresh (bool):
+            Ask caches (e.g. requests_cache) to fetch a fresh copy of the page.
     Returns:
         html (str):
             The HTML of the page, as text.
+    Raises:
+        FetchError:
+            If the page could not be fetched, even after retrying.
     """
+    if archive is not None and not refresh:
+        html_str = archive.get(url)
+        if html_str is not None:
+            return html_str
+
     headers = {"User-Agent": "NBA-Statistics-Crawler/1.0"}
-    # passing the optional parameters argument to the get function
-    response = None
-    if (headers):
-        response = requests.get(url, headers=headers)
-    else:
-        response = requests.get(url)
+    if refresh:
+        headers["Cache-Control"] = "no-cache"
+    response = request("GET", url, headers=headers)
 
     html_str = response.text
+    if archive is not None:
+        archive.put(url, html_str)
+
+    return html_str
+
+
+def use_snapshot_archive(path: str) -> SnapshotArchive:
+    """Make get_html read pages from and store them in a snapshot archive.
+
+    Args:
+        path (str):
+            Directory of the archive, created if needed.
+    Returns:
+        archive (SnapshotArchive):
+            The archive, it is flushed when the process exits.
+    """
+    global archive
+    archive = SnapshotArchive(path)
+    atexit.register(archive.close)
+    return archive
+
+
+def use_memory_budget(limit: Optional[int]) -> Optional[MemoryBudget]:
+    """Check the memory of this process against `limit` bytes before every request.
+
+    Args:
+        limit (int):
+            The budget for the resident memory of the process, in bytes,
+            or None to stop checking.
+    Returns:
+        memory_budget (MemoryBudget):
+            The budget, with counters of how often the process was over it.
+    """
+    global memory_budget
+    memory_budget = MemoryBudget(limit) if limit is not None else None
+    return memory_budget
+
+
+class FetchError(Exception):
+    """A url could not be fetched, even after retrying."""
+
+    def __init__(self, url: str, reason: str):
+        super().__init__(f"could not fetch {url}: {reason}")
+        self.url = url
+        self.reason = reason
+
+
+class TokenBucket:
+    """Thread-safe token bucket, allowing `rate` requests per second
+    with bursts of up to `capacity` requests."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, waiting until one is available."""
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class CircuitBreaker:
+    """Pauses requests to a host after `threshold` failed requests in a row.
+
+    A request counts as failed when it gave up after all its retries with
+    a host-level failure (throttling, unavailable, timeout, connection
+    error), so one broken page doesn't stop the rest of the host. While
+    open, requests wait until `cooldown` seconds have passed, then they are
+    let through again and the first success closes it.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            return self.opened_at is None or monotonic() - self.opened_at >= self.cooldown
+
+    def wait(self) -> None:
+        """Wait until requests are let through again."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.cooldown - (monotonic() - self.opened_at)
+        if remaining > 0:
+            sleep(remaining)
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = monotonic()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """Transport adapter taking a token from the rate limiter for every
+    request sent over the network (cache hits never get this far)."""
+
+    def send(self, request, **kwargs):
+        rate_limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+# shared by all threads, wikipedia asks crawlers to keep a modest request rate
+rate_limiter = TokenBucket(rate=10, capacity=10)
+_breakers = {}
+_breakers_lock = threading.Lock()
+_session = None
+
+
+def get_session() -> requests.Session:
+    """Get the session used for all requests.
+
+    It is created on first use, so a cache installed by requests_cache
+    after this module is imported is still used.
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = RateLimitedAdapter(pool_maxsize=32)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+
+
+def request(method: str, url: str, retries: int = 5, timeout: float = 30, **kwargs):
+    """Send a request, retrying throttled and failed requests.
+
+    Retries use jittered exponential backoff and wait at least as long as
+    a Retry-After header asks. A circuit breaker per host pauses requests
+    to a host that keeps failing.
+
+    Args:
+        method (str):
+            HTTP method, e.g. "GET".
+        url (str):
+            The URL to request.
+        retries (int):
+            How many times to retry after the first attempt.
+        timeout (float):
+            Seconds to wait for the server.
+        **kwargs:
+            Passed on to requests.
+    Returns:
+        response (requests.Response):
+            A response with a successful status code.
+    Raises:
+        FetchError:
+            If there was no successful response, the reason is also
+            recorded in `failures`.
+    """
+    if memory_budget is not None:
+        memory_budget.check()
+    host = urlparse(url).netloc
+    with _breakers_lock:
+        breaker = _breakers.setdefault(host, CircuitBreaker())
+
+    host_failure = False
+    for attempt in range(retries + 1):
+        breaker.wait()
+        retry_after = None
+        try:
+            with stage("network", url):
+                response = get_session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            reason = f"{type(e).__name__}: {e}"
+            host_failure = True
+        else:
+            if response.status_code not in retry_statuses:
+                breaker.record_success()
+                if response.status_code >= 400:
+                    reason = f"HTTP {response.status_code}"
+                    break
+                return response
+            reason = f"HTTP {response.status_code}"
+            host_failure = response.status_code in host_statuses
+            retry_after = get_retry_after(response)
+            if retry_after is not None and retry_after > backoff_cap:
+                # Rather fail this url than hold up the whole crawl
+                reason += f", asked to retry after {retry_after:.0f} s"
+                break
+        if attempt < retries:
+            sleep(backoff_delay(attempt, retry_after))
+
+    if host_failure:
+        breaker.record_failure()
+    failures[url] = reason
+    raise FetchError(url, reason)
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Seconds to wait before retry number `attempt` (counting from 0), at most backoff_cap."""
+    delay = random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, backoff_cap))
+    return delay
+
+
+def get_retry_after(response) -> Optional[float]:
+    """Seconds asked for by the Retry-After header of a response, if any."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def title_from_url(url: str) -> str:
+    """Get the article title of a wikipedia url.
+
+    Args:
+        url (str):
+            A wikipedia article url, e.g. https://en.wikipedia.org/wiki/Star_Wars
+    Returns:
+        title (str):
+            The article title, e.g. 'Star Wars'
+    """
+    title = url.split("/wiki/", 1)[-1].split("#")[0]
+    return unquote(title).replace("_", " ")
+
+
+def get_revision_ids(urls: Iterable[str], batch_size: int = 50) -> Dict[str, int]:
+    """Get the latest revision id of many wikipedia articles.
+
+    The MediaWiki API accepts up to 50 titles per query,
+    so this takes a handful of small requests instead of one per page.
+
+    Args:
+        urls (iterable):
+            Wikipedia article urls.
+        batch_size (int):
+            Number of titles per API request.
+    Returns:
+        revisions (dict):
+            {url: revision id}, urls of missing pages are left out.
+    """
+    headers = {"User-Agent": "NBA-Statistics-Crawler/1.0", "Cache-Control": "no-cache"}
+    titles = {url: title_from_url(url) for url in urls}
+    unique_titles = sorted(set(titles.values()))
+
+    revisions = {}
+    for i in range(0, len(unique_titles), batch_size):
+        batch = unique_titles[i:i + batch_size]
+        params = {
+            "action": "query",
+            "prop": "revisions",
+            "rvprop": "ids",
+            "titles": "|".join(batch),
+            "redirects": 1,
+            "format": "json",
+            "formatversion": 2,
+        }
+        response = request("GET", api_url, params=params, headers=headers)
+        query = response.json().get("query", {})
+
+        # The API reports titles it normalized or followed as redirects
+        aliases = {}
+        for item in query.get("normalized", []) + query.get("redirects", []):
+            aliases[item["from"]] = item["to"]
+        latest = {
+            page["title"]: page["revisions"][0]["revid"]
+            for page in query.get("pages", [])
+            if page.get("revisions")
+        }
+        for title in batch:
+            resolved = _resolve_title(title, aliases)
+            if resolved in latest:
+                revisions[title] = latest[resolved]
+
+    return {url: revisions[title] for url, title in titles.items() if title in revisions}
+
 
-    return html_str
\ No newline at end of file
+def _resolve_title(title: str, aliases: Dict[str, str]) -> str:
+    """Follow normalizations and redirects reported by the MediaWiki API."""
+    seen = set()
+    while title in aliases and title not in seen:
+        seen.add(title)
+        title = aliases[title]
+    return title
+
+
+def get_sections_html(
+    urls: Iterable[str],
+    section_names: List[str],
+    batch_size: int = 20,
+) -> Dict[str, str]:
+    """Get a section of many wikipedia articles through the MediaWiki API.
+
+    Instead of downloading the full rendered page of every article
+    (skins, navboxes, references, ...), the wikitext of up to `batch_size`
+    articles is fetched in one query, the wanted section is cut out of each,
+    and all sections are rendered to html together in one parse request.
+    The html of each article is a heading with the id of the section
+    followed by the rendered section, so it can be fed to the same
+    extraction code as the full page.
+
+    Args:
+        urls (iterable):
+            Wikipedia article urls.
+        section_names (list):
+            Section headings to look for, e.g. ["Regular season", "NBA"].
+            The first one found in an article is used.
+        batch_size (int):
+            Number of articles per pair of API requests.
+    Returns:
+        pages (dict):
+            {url: html}, empty for articles without any of the sections.
+    """
+    headers = {"User-Agent": "NBA-Statistics-Crawler/1.0"}
+    titles = {url: title_from_url(url) for url in urls}
+    unique_titles = sorted(set(titles.values()))
+
+    sections = {}
+    for i in range(0, len(unique_titles), batch_size):
+        batch = unique_titles[i:i + batch_size]
+        params = {
+            "action": "query",
+            "prop": "revisions",
+            "rvprop": "content",
+            "rvslots": "main",
+            "titles": "|".join(batch),
+            "redirects": 1,
+            "format": "json",
+            "formatversion": 2,
+        }
+        response = request("GET", api_url, params=params, headers=headers)
+        query = response.json().get("query", {})
+
+        aliases = {}
+        for item in query.get("normalized", []) + query.get("redirects", []):
+            aliases[item["from"]] = item["to"]
+        wikitexts = {
+            page["title"]: page["revisions"][0]["slots"]["main"]["content"]
+            for page in query.get("pages", [])
+            if page.get("revisions")
+        }
+
+        # Cut out the wanted section of every article in the batch
+        batch_sections = []
+        for title in batch:
+            wikitext = wikitexts.get(_resolve_title(title, aliases), "")
+            for name in section_names:
+                body = find_wikitext_section(wikitext, name)
+                if body is not None:
+                    batch_sections.append((title, name, body))
+                    break
+
+        # Render all of them at once, each wrapped in a div so they can be split again
+        text = "\n".join(
+            f'<div class="nba-statistics-section" data-index="{n}">\n{body}\n</div>'
+            for n, (title, name, body) in enumerate(batch_sections)
+        )
+        if not text:
+            continue
+        data = {
+            "action": "parse",
+            "text": text,
+            "contentmodel": "wikitext",
+            "prop": "text",
+            "disableeditsection": 1,
+            "disablelimitreport": 1,
+            "format": "json",
+            "formatversion": 2,
+        }
+        response = request("POST", api_url, data=data, headers=headers)
+        soup = BeautifulSoup(response.json()["parse"]["text"], "html.parser")
+        for div in soup.find_all("div", class_="nba-statistics-section"):
+            title, name, body = batch_sections[int(div["data-index"])]
+            section_id = name.replace(" ", "_")
+            sections[title] = f'<h2 id="{section_id}">{name}</h2>\n{div.decode_contents()}'
+        free_soup(soup)
+
+    return {url: sections.get(title, "") for url, title in titles.items()}
+
+
+def free_soup(soup: BeautifulSoup) -> None:
+    """Free a parse tree right away.
+
+    The parent and sibling links of a tree are reference cycles, so without
+    this it stays in memory until the next garbage collection. Nothing
+    taken from the tree may be used afterwards, except plain strings.
+
+    Args:
+        soup (BeautifulSoup):
+            The tree.
+    """
+    # decompose() of the root alone leaves the elements under it intact
+    for element in list(soup.contents):
+        element.decompose()
+    soup.decompose()
+
+
+def find_wikitext_section(wikitext: str, name: str) -> Optional[str]:
+    """Find the body of the first section with a given heading in wikitext.
+
+    Args:
+        wikitext (str):
+            Wikitext of an article.
+        name (str):
+            The section heading, e.g. "Roster".
+    Returns:
+        body (str):
+            The wikitext between the heading and the next heading
+            of the same or a higher level, or None if there is no such section.
+    """
+    headings = list(heading_pattern.finditer(wikitext))
+    for i, match in enumerate(headings):
+        if match.group(2) != name:
+            continue
+        level = len(match.group(1))
+        end = len(wikitext)
+        for following in headings[i + 1:]:
+            if len(following.group(1)) <= level:
+                end = following.start()
+                break
+        return wikitext[match.end():end]
+    return None
@@ -0,0 +1,318 @@
+import hashlib
+import json
+import mmap
+import os
+import sys
+import threading
+import zlib
+from collections import Counter
+from typing import Iterable, List, Optional
+
+# zlib only looks back 32 KB, so a preset dictionary can't be larger than that
+max_dictionary_size = 32 * 1024
+
+
+class SnapshotArchive:
+    """Content-addressed, compressed archive of fetched pages.
+
+    Pages are cut into chunks at content-defined boundaries, so the parts
+    many wikipedia pages share (skin, navboxes, footer) become identical
+    chunks, which are stored once under their sha256. Every chunk is
+    compressed with zlib, using a preset dictionary trained on the stored
+    pages (see compact). Chunks are appended to a pack file and read back
+    through a memory map, an index file maps urls to chunk hashes and
+    chunk hashes to their offset in the pack.
+
+    The archive is a directory with the files:
+        pack : compressed chunks
+        index.json : {"pages": {url: [hash, ...]}, "chunks": {hash: [offset, length, dictionary]}}
+        dictionary : the trained zlib dictionary, if any
+
+    compact writes a new pack and dictionary next to the old ones (as
+    pack.<generation> and dictionary.<generation>), and only switches
+    to them when the index naming them is replaced, so a crash while
+    compacting leaves the old archive intact. The archive compacts itself
+    when closed after `compact_after` new pages.
+
+    Only one process should write to an archive at a time.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        min_chunk: int = 2048,
+        max_chunk: int = 16384,
+        boundary: int = 32,
+        compact_after: int = 100,
+    ):
+        self.path = path
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.boundary = boundary
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.index_path = os.path.join(path, "index.json")
+
+        self.pages = {}
+        self.chunks = {}
+        self.generation = 0
+        self.uncompacted = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.pages = index["pages"]
+            self.chunks = index["chunks"]
+            self.generation = index.get("generation", 0)
+            self.uncompacted = index.get("uncompacted", 0)
+        self.pack_path = self._file("pack", self.generation)
+        self.dictionary_path = self._file("dictionary", self.generation)
+        self.dictionary = b""
+        if os.path.exists(self.dictionary_path):
+            with open(self.dictionary_path, "rb") as f:
+                self.dictionary = f.read()
+
+        self.pack = open(self.pack_path, "ab")
+        self.map = None
+        self.dirty = 0
+
+    def get(self, url: str) -> Optional[str]:
+        """The stored page of a url, or None if it is not in the archive."""
+        hashes = self.pages.get(url)
+        if hashes is None:
+            return None
+        with self.lock:
+            return b"".join(self._read_chunk(h) for h in hashes).decode()
+
+    def put(self, url: str, html: str) -> None:
+        """Store the page of a url, replacing an earlier snapshot."""
+        with self.lock:
+            hashes = []
+            for chunk in self.split(html.encode()):
+                digest = hashlib.sha256(chunk).hexdigest()
+                if digest not in self.chunks:
+                    self._write_chunk(digest, chunk)
+                hashes.append(digest)
+            self.pages[url] = hashes
+            self.dirty += 1
+            self.uncompacted += 1
+            if self.dirty >= 100:
+                self._save_index()
+
+    def split(self, data: bytes) -> List[bytes]:
+        """Cut data into chunks at line ends chosen by the content of the line.
+
+        A chunk ends after a line whose crc32 is divisible by `boundary`, once
+        it is at least min_chunk bytes, or after max_chunk bytes. Boundaries
+        only depend on nearby content, so shared parts of different pages
+        are cut the same way.
+        """
+        chunks = []
+        start = 0
+        position = 0
+        while position < len(data):
+            end = data.find(b"\n", position)
+            end = len(data) if end == -1 else end + 1
+            size = end - start
+            if size >= self.max_chunk or (
+                size >= self.min_chunk and zlib.crc32(data[position:end]) % self.boundary == 0
+            ):
+                chunks.append(data[start:end])
+                start = end
+            position = end
+        if start < len(data):
+            chunks.append(data[start:])
+        return chunks
+
+    def compact(self) -> None:
+        """Train a new dictionary on the stored chunks and rewrite the pack with it.
+
+        The dictionary is dropped if it doesn't pay for itself.
+        Chunks no page refers to any more are dropped.
+        """
+        with self.lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        used = {h for hashes in self.pages.values() for h in hashes}
+        contents = {h: self._read_chunk(h) for h in used}
+        dictionary = train_dictionary(contents.values())
+        # Only keep the dictionary if it saves more than its own size
+        plain = sum(len(_compress(chunk, b"")) for chunk in contents.values())
+        with_dictionary = len(dictionary) + sum(
+            len(_compress(chunk, dictionary)) for chunk in contents.values()
+        )
+        dictionary = dictionary if with_dictionary < plain else b""
+
+        # The new files, unused until the index refers to them
+        generation = self.generation + 1
+        dictionary_path = self._file("dictionary", generation)
+        with open(dictionary_path, "wb") as f:
+            f.write(dictionary)
+            f.flush()
+            os.fsync(f.fileno())
+        self._close_map()
+        self.pack.close()
+        old_paths = [self.pack_path, self.dictionary_path]
+        self.pack_path = self._file("pack", generation)
+        self.pack = open(self.pack_path, "wb")
+        self.dictionary = dictionary
+        self.dictionary_path = dictionary_path
+        self.chunks = {}
+        for digest, chunk in contents.items():
+            self._write_chunk(digest, chunk)
+        self.generation = generation
+        self.uncompacted = 0
+        self._save_index()
+
+        for path in old_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def size(self) -> int:
+        """Bytes used on disk by the archive."""
+        return sum(
+            os.path.getsize(p)
+            for p in (self.pack_path, self.index_path, self.dictionary_path)
+            if os.path.exists(p)
+        )
+
+    def flush(self) -> None:
+        """Write buffered chunks and the index to disk."""
+        with self.lock:
+            self._save_index()
+
+    def close(self) -> None:
+        """Write everything to disk, compacting first after compact_after new pages."""
+        if self.pack.closed:
+            return
+        with self.lock:
+            if self.uncompacted >= self.compact_after:
+                self._compact()
+            else:
+                self._save_index()
+            self._close_map()
+            self.pack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _file(self, name: str, generation: int) -> str:
+        return os.path.join(self.path, name if generation == 0 else f"{name}.{generation}")
+
+    def _write_chunk(self, digest: str, chunk: bytes) -> None:
+        data = _compress(chunk, self.dictionary)
+        offset = self.pack.tell()
+        self.pack.write(data)
+        self.chunks[digest] = [offset, len(data), 1 if self.dictionary else 0]
+
+    def _read_chunk(self, digest: str) -> bytes:
+        offset, length, uses_dictionary = self.chunks[digest]
+        if self.map is None or offset + length > len(self.map):
+            # The pack grew since it was mapped
+            self.pack.flush()
+            self._close_map()
+            with open(self.pack_path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.map[offset:offset + length]
+        if uses_dictionary:
+            decompressor = zlib.decompressobj(zdict=self.dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def _close_map(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def _save_index(self) -> None:
+        self.pack.flush()
+        os.fsync(self.pack.fileno())
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "pages": self.pages,
+                    "chunks": self.chunks,
+                    "generation": self.generation,
+                    "uncompacted": self.uncompacted,
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self.dirty = 0
+
+
+def _compress(data: bytes, dictionary: bytes) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(9, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(9)
+    return compressor.compress(data) + compressor.flush()
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = max_dictionary_size) -> bytes:
+    """Build a zlib preset dictionary from the pieces of html repeated most in samples.
+
+    The samples are cut into pieces ending at '>' (roughly a tag and the text
+    before it). Pieces are scored by the bytes they would save, and the best
+    are put last in the dictionary, where zlib can refer to them cheapest.
+
+    arguments:
+        samples (iterable) : sample contents, e.g. chunks of pages
+        size (int) : maximum size of the dictionary in bytes
+    returns:
+        dictionary (bytes)
+    """
+    counts = Counter()
+    for sample in samples:
+        counts.update(piece for piece in sample.split(b">") if len(piece) >= 8)
+    scored = sorted(
+        ((count - 1) * (len(piece) + 1), piece)
+        for piece, count in counts.items()
+        if count > 1
+    )
+    dictionary = []
+    total = 0
+    for score, piece in reversed(scored):
+        if total + len(piece) + 1 > size:
+            continue
+        dictionary.append(piece + b">")
+        total += len(piece) + 1
+    return b"".join(reversed(dictionary))
+
+
+def import_requests_cache(cache_name: str, archive: SnapshotArchive) -> int:
+    """Copy the html pages of a requests_cache SQLite cache into an archive.
+
+    arguments:
+        cache_name (str) : the requests_cache cache, e.g. 'http_cache'
+        archive (SnapshotArchive) : the archive to store the pages in
+    returns:
+        (int) : number of pages copied
+    """
+    import requests_cache
+
+    session = requests_cache.CachedSession(cache_name, backend="sqlite")
+    count = 0
+    for response in session.cache.responses.values():
+        if response.status_code == 200 and "html" in response.headers.get("Content-Type", ""):
+            archive.put(response.url, response.text)
+            count += 1
+    archive.flush()
+    return count
+
+
+if __name__ == "__main__":
+    # python snapshot_archive.py <requests_cache name> <archive directory>
+    if len(sys.argv) != 3:
+        sys.exit("usage: python snapshot_archive.py <requests_cache name> <archive directory>")
+    with SnapshotArchive(sys.argv[2]) as archive:
+        n = import_requests_cache(sys.argv[1], archive)
+        archive.compact()
+        print(f"Imported {n} pages, archive is {archive.size()} bytes")
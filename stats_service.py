@@ -0,0 +1,372 @@
+import http.client
+import inspect
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+import fetch_player_statistics
+from derived_metrics import StatsTable, leaders, metrics, rank
+
+playoff_url = "https://en.wikipedia.org/wiki/2022_NBA_playoffs"
+
+# pyplot keeps global state, so charts are drawn one at a time
+_plot_lock = threading.Lock()
+
+
+class LRUCache:
+    """Thread-safe cache keeping the `maxsize` most recently used results."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute: Callable):
+        """The cached value of key, computed and stored on a miss."""
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+
+class QueryError(Exception):
+    """A query with bad parameters, answered with 400."""
+
+
+class StatsService:
+    """Scraped stats kept in memory, answering queries from an LRU cache.
+
+    The stats are loaded once (see refresh) into a StatsTable with all
+    derived metrics computed. Rendered query results and charts are cached
+    until the next refresh swaps in new stats.
+    """
+
+    def __init__(self, url: str = playoff_url, season: str = "2021", cache_size: int = 256):
+        self.url = url
+        self.season = season
+        self.cache = LRUCache(cache_size)
+        self.lock = threading.Lock()
+        self.version = 0
+        self.teams = []
+        self.table = StatsTable.from_indexes({})
+        self.refreshing = False
+        self.last_error = None
+
+    def load(self, all_players: Dict[str, List[Dict]], indexes: Dict[str, dict] = None) -> None:
+        """Swap in new stats.
+
+        arguments:
+            all_players (dict) : {team name: [player dicts]}, see collect_players
+            indexes (dict) : {player url: {season: {team: stats}}}, defaults to
+                the parsed-result store of fetch_player_statistics
+        """
+        if indexes is None:
+            indexes = fetch_player_statistics._stats_index
+        names = {p["url"]: p["name"] for players in all_players.values() for p in players}
+        table = StatsTable.from_indexes({url: indexes.get(url, {}) for url in names}, names)
+        table.compute()
+        with self.lock:
+            self.teams = sorted(all_players)
+            self.table = table
+            self.version += 1
+        self.cache.clear()
+
+    def refresh(self) -> None:
+        """Run the scraping pipeline on freshly fetched pages and load its results."""
+        self.load(fetch_player_statistics.collect_players(self.url, refresh=True))
+
+    def start_refresh(self) -> bool:
+        """Refresh in a background thread, queries keep using the old stats meanwhile.
+
+        returns:
+            (bool) : False if a refresh is already running
+        """
+        with self.lock:
+            if self.refreshing:
+                return False
+            self.refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+        return True
+
+    def start_periodic_refresh(self, interval: float) -> None:
+        """Start a background refresh every `interval` seconds."""
+        def loop():
+            while not stop.wait(interval):
+                self.start_refresh()
+        stop = threading.Event()
+        threading.Thread(target=loop, daemon=True).start()
+
+    def _background_refresh(self) -> None:
+        try:
+            self.refresh()
+            self.last_error = None
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def query(self, path: str, params: Dict[str, str]) -> Tuple[int, str, bytes]:
+        """Answer a GET request.
+
+        returns:
+            status, content type, body
+        """
+        handlers = {
+            "/teams": self.get_teams,
+            "/top": self.get_top,
+            "/player": self.get_player,
+            "/leaders": self.get_leaders,
+        }
+        key = (self.version, path, tuple(sorted(params.items())))
+        try:
+            if path == "/status":
+                return 200, "application/json", _to_json(self.get_status())
+            if path == "/chart":
+                _check_params(self.render_chart, params)
+                return 200, "image/png", self.cache.get(key, lambda: self.render_chart(**params))
+            if path not in handlers:
+                return 404, "application/json", _to_json({"error": f"no such endpoint {path}"})
+            _check_params(handlers[path], params)
+            body = self.cache.get(key, lambda: _to_json(handlers[path](**params)))
+            return 200, "application/json", body
+        except QueryError as e:
+            return 400, "application/json", _to_json({"error": str(e)})
+        except Exception as e:
+            # A bug rather than a bad query
+            traceback.print_exc()
+            return 500, "application/json", _to_json({"error": f"{type(e).__name__}: {e}"})
+
+    def get_teams(self) -> List[str]:
+        return self.teams
+
+    def get_top(
+        self,
+        stat: str = "points",
+        k: str = "3",
+        team: str = None,
+        season: str = None,
+    ) -> Dict[str, List[Dict]]:
+        """The top k players of every team (or one team) by a stat or metric."""
+        self._check_stat(stat)
+        teams = [team] if team else self.teams
+        return rank(self.table, stat, season or self.season, teams, _to_int(k))
+
+    def get_player(self, name: str) -> List[Dict]:
+        """All seasons of the players whose name contains `name`."""
+        table = self.table
+        lowered = name.lower()
+        rows = [row for row, player in enumerate(table["name"]) if lowered in player.lower()]
+        columns = [c for c in table.columns if c != "url"]
+        return [{c: _to_python(table[c][row]) for c in columns} for row in rows]
+
+    def get_leaders(self, stat: str = "points", k: str = "10", season: str = None) -> List[Dict]:
+        """The top k players over all teams in a season."""
+        self._check_stat(stat)
+        return leaders(self.table, stat, season or self.season, _to_int(k))
+
+    def get_status(self) -> Dict:
+        return {
+            "version": self.version,
+            "players": len(set(self.table["url"])),
+            "refreshing": self.refreshing,
+            "last_error": self.last_error,
+            "cache": {"hits": self.cache.hits, "misses": self.cache.misses},
+        }
+
+    def render_chart(self, stat: str = "points", season: str = None) -> bytes:
+        """A png of the top 3 of every team, drawn with plot_best."""
+        best = self.get_top(stat, "3", season=season)
+        with _plot_lock, tempfile.TemporaryDirectory() as stats_dir:
+            fetch_player_statistics.plot_best(best, stat, stats_dir=stats_dir)
+            with open(os.path.join(stats_dir, f"{stat}.png"), "rb") as f:
+                return f.read()
+
+    def _check_stat(self, stat: str) -> None:
+        if stat not in self.table.columns and stat not in metrics:
+            raise QueryError(f"unknown stat {stat}")
+        if stat in self.table.columns and self.table.columns[stat].dtype.kind != "f":
+            raise QueryError(f"not a numeric stat: {stat}")
+
+
+def _check_params(handler: Callable, params: Dict[str, str]) -> None:
+    """Raise QueryError unless handler takes exactly these parameters."""
+    try:
+        inspect.signature(handler).bind(**params)
+    except TypeError as e:
+        raise QueryError(f"bad parameters: {e}")
+
+
+def _to_int(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise QueryError(f"not a number: {value}")
+
+
+def _to_python(value):
+    """Json friendly value, numpy scalars become python values and nan becomes None."""
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _to_json(data) -> bytes:
+    def clean(value):
+        if isinstance(value, dict):
+            return {k: clean(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [clean(v) for v in value]
+        return _to_python(value)
+    return json.dumps(clean(data)).encode()
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    """GET /teams, /top, /player, /leaders, /chart and /status, POST /refresh"""
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        status, content_type, body = self.server.service.query(parsed.path, params)
+        self.reply(status, content_type, body)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/refresh":
+            self.reply(404, "application/json", _to_json({"error": "no such endpoint"}))
+            return
+        started = self.server.service.start_refresh()
+        self.reply(202, "application/json", _to_json({"started": started}))
+
+    def reply(self, status: int, content_type: str, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(service: StatsService, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+    """Create a threaded http server for a service, call serve_forever to run it."""
+    server = ThreadingHTTPServer((host, port), StatsRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+default_load_paths = [
+    "/teams",
+    "/top?stat=points",
+    "/top?stat=assists&k=5",
+    "/top?stat=points_per_36&team=Boston",
+    "/leaders?stat=points",
+    "/leaders?stat=scoring_share&k=20",
+    "/player?name=Curry",
+    "/chart?stat=points",
+]
+
+
+def load_test(
+    base_url: str,
+    paths: List[str] = None,
+    requests: int = 1000,
+    concurrency: int = 8,
+) -> Dict[str, float]:
+    """Drive a running service with concurrent requests and measure latency.
+
+    arguments:
+        base_url (str) : e.g. 'http://127.0.0.1:8000'
+        paths (list) : request paths, used round robin
+        requests (int) : total number of requests
+        concurrency (int) : number of concurrent clients
+    returns:
+        results (dict) : requests, errors, seconds, requests per second and
+            latency percentiles p50, p95, p99 and max in milliseconds
+    """
+    paths = paths or default_load_paths
+
+    def one(i):
+        start = perf_counter()
+        try:
+            with urlopen(base_url + paths[i % len(paths)]) as response:
+                response.read()
+            ok = True
+        except (OSError, http.client.HTTPException):
+            # error statuses, refused and dropped connections
+            ok = False
+        return perf_counter() - start, ok
+
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    seconds = perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, ok in results)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    return {
+        "requests": requests,
+        "errors": sum(1 for latency, ok in results if not ok),
+        "seconds": seconds,
+        "requests_per_second": requests / seconds,
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": latencies[-1],
+    }
+
+
+if __name__ == "__main__":
+    usage = (
+        "usage: python stats_service.py serve [port] [refresh interval in seconds]\n"
+        "       python stats_service.py loadtest [base url] [requests] [concurrency]"
+    )
+    if len(sys.argv) < 2:
+        sys.exit(usage)
+    if sys.argv[1] == "serve":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+        service = StatsService()
+        service.refresh()
+        if len(sys.argv) > 3:
+            service.start_periodic_refresh(float(sys.argv[3]))
+        print(f"Serving on http://127.0.0.1:{port}")
+        serve(service, port=port).serve_forever()
+    elif sys.argv[1] == "loadtest":
+        base_url = sys.argv[2] if len(sys.argv) > 2 else "http://127.0.0.1:8000"
+        requests = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+        concurrency = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+        print(json.dumps(load_test(base_url, requests=requests, concurrency=concurrency), indent=4))
+    else:
+        sys.exit(usage)
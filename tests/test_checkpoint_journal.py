@@ -0,0 +1,56 @@
+from checkpoint_journal import CheckpointJournal
+
+
+def test_record_and_replay(tmpdir):
+    path = str(tmpdir.join("run.journal"))
+    with CheckpointJournal(path) as journal:
+        assert journal.replay() == {}
+        journal.record("players", "Boston", [{"name": "Tatum, Jayson"}])
+        journal.record("stats", "https://a", {"2021": {}})
+        journal.record("stats", "https://a", {"2022": {}})
+
+    done = CheckpointJournal(path).replay()
+    assert done == {
+        "players": {"Boston": [{"name": "Tatum, Jayson"}]},
+        "stats": {"https://a": {"2022": {}}},
+    }
+
+
+def test_batched_writes(tmpdir):
+    path = tmpdir.join("run.journal")
+    journal = CheckpointJournal(str(path), batch_size=3, flush_interval=3600)
+    journal.record("stats", "https://a", {})
+    journal.record("stats", "https://b", {})
+    # nothing is written before a batch is full
+    assert not path.exists()
+    journal.record("stats", "https://c", {})
+    assert len(path.readlines()) == 3
+    journal.record("stats", "https://d", {})
+    journal.close()
+    assert len(path.readlines()) == 4
+
+
+def test_replay_truncated(tmpdir):
+    path = tmpdir.join("run.journal")
+    with CheckpointJournal(str(path)) as journal:
+        journal.record("stats", "https://a", {"2021": {}})
+    # a crash while writing leaves half a line
+    path.write('{"kind": "stats", "key": "https://b", "va', mode="a")
+    assert CheckpointJournal(str(path)).replay() == {"stats": {"https://a": {"2021": {}}}}
+
+    # the resumed run records more, and all of it is replayed next time
+    with CheckpointJournal(str(path)) as journal:
+        journal.record("stats", "https://c", {})
+        journal.record("stats", "https://d", {})
+    assert CheckpointJournal(str(path)).replay() == {
+        "stats": {"https://a": {"2021": {}}, "https://c": {}, "https://d": {}},
+    }
+
+
+def test_finish(tmpdir):
+    path = tmpdir.join("run.journal")
+    journal = CheckpointJournal(str(path))
+    journal.record("stats", "https://a", {})
+    journal.finish()
+    assert not path.exists()
+    assert CheckpointJournal(str(path)).replay() == {}
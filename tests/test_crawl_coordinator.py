@@ -0,0 +1,127 @@
+import multiprocessing
+from time import sleep
+
+import fetch_player_statistics
+import pytest
+from crawl_coordinator import WorkQueue, crawl_best_players, merge_results, run_worker, start_crawl
+
+
+@pytest.fixture
+def queue(tmpdir):
+    queue = WorkQueue(str(tmpdir.join("queue.sqlite")))
+    yield queue
+    queue.close()
+
+
+def test_lease_and_complete(queue):
+    queue.enqueue("stats", ["a", "b", "c"], shard_size=2)
+    first = queue.lease("w1", lease_seconds=60)
+    second = queue.lease("w2", lease_seconds=60)
+    assert first["items"] == ["a", "b"]
+    assert second["items"] == ["c"]
+    assert queue.lease("w3", lease_seconds=60) is None
+
+    # only the worker holding the lease can complete it
+    assert not queue.complete(first["id"], "w2", {"x": 1})
+    assert queue.complete(first["id"], "w1", {"x": 1}, {"stats": ["d"]})
+    assert queue.results("stats") == [{"x": 1}]
+    assert queue.unfinished() == 2
+
+
+def test_expired_lease_is_reassigned(queue):
+    queue.enqueue("stats", ["a"], shard_size=1)
+    shard = queue.lease("crashed", lease_seconds=0.01)
+    sleep(0.02)
+    again = queue.lease("w2", lease_seconds=60)
+    assert again["id"] == shard["id"]
+    # the crashed worker lost its lease
+    assert not queue.heartbeat(shard["id"], "crashed", 60)
+    assert queue.heartbeat(shard["id"], "w2", 60)
+
+
+def test_release_fails_after_max_attempts(queue):
+    queue.max_attempts = 2
+    queue.enqueue("stats", ["a"], shard_size=1)
+    for _ in range(2):
+        shard = queue.lease("w1", lease_seconds=60)
+        queue.release(shard["id"], "w1", "ValueError: broken")
+    assert queue.lease("w1", lease_seconds=60) is None
+    assert queue.errors() == {shard["id"]: "ValueError: broken"}
+
+
+def test_expired_lease_fails_after_max_attempts(queue):
+    # a shard that kills every worker leasing it
+    queue.max_attempts = 2
+    queue.enqueue("stats", ["a"], shard_size=1)
+    for _ in range(2):
+        shard = queue.lease("crashed", lease_seconds=0.01)
+        sleep(0.02)
+    assert queue.lease("w1", lease_seconds=60) is None
+    assert queue.unfinished() == 0
+    assert queue.errors() == {shard["id"]: "lease ran out 2 times, its workers crashed"}
+
+
+@pytest.fixture
+def fake_crawl(monkeypatch):
+    teams = [{"name": f"Team{i}", "url": f"https://t/{i}"} for i in range(8)]
+    crawl = {"get_teams": 0, "plotted": []}
+
+    def fake_get_teams(url):
+        crawl["get_teams"] += 1
+        return teams
+
+    def fake_get_players(team_url):
+        i = team_url.rsplit("/", 1)[1]
+        return [{"name": f"P{i}{j}", "url": f"https://p/{i}/{j}"} for j in range(4)]
+
+    def fake_get_player_stats_index(player_url):
+        i, j = player_url.split("/")[-2:]
+        stats = {"points": float(j), "assists": 1.0, "rebounds": 2.0}
+        return {"2021": {f"Team{i} Full Name": stats}}
+
+    monkeypatch.setattr(fetch_player_statistics, "get_teams", fake_get_teams)
+    monkeypatch.setattr(fetch_player_statistics, "get_players", fake_get_players)
+    monkeypatch.setattr(
+        fetch_player_statistics, "get_player_stats_index", fake_get_player_stats_index
+    )
+    monkeypatch.setattr(
+        fetch_player_statistics, "plot_best", lambda best, stat: crawl["plotted"].append(stat)
+    )
+    return crawl
+
+
+def test_crawl(fake_crawl, tmpdir):
+    path = str(tmpdir.join("queue.sqlite"))
+    start_crawl("https://playoffs", path, shard_size=3)
+
+    # a worker crashes while holding a shard, another one finishes the crawl
+    crashed = WorkQueue(path)
+    crashed.lease("crashed", lease_seconds=0.01)
+    crashed.close()
+    sleep(0.02)
+    run_worker(path, worker="w1", poll_interval=0.01)
+
+    best = merge_results(path)
+    assert len(best) == 8
+    assert sorted(p["name"] for p in best["Team5"]) == ["P51", "P52", "P53"]
+    assert sorted(p["points"] for p in best["Team5"]) == [1.0, 2.0, 3.0]
+
+
+def test_crawl_best_players_unfinished(fake_crawl, tmpdir):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the workers need the patched fetch functions")
+    path = str(tmpdir.join("queue.sqlite"))
+    # every worker died before finishing the crawl
+    with pytest.raises(RuntimeError, match="8 shards are unfinished"):
+        crawl_best_players("https://playoffs", path, processes=0)
+    assert fake_crawl["plotted"] == []
+
+    # the unfinished queue is resumed
+    crawl_best_players("https://playoffs", path, processes=2)
+    assert fake_crawl["get_teams"] == 1
+    assert fake_crawl["plotted"] == ["points", "assists", "rebounds"]
+
+    # a finished queue is replaced by a new crawl
+    with pytest.raises(RuntimeError, match="unfinished"):
+        crawl_best_players("https://playoffs", path, processes=0)
+    assert fake_crawl["get_teams"] == 2
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from derived_metrics import (
+    StatsTable,
+    group_codes,
+    group_zscore,
+    leaders,
+    metrics,
+    rank,
+    register_metric,
+)
+
+
+def stats(points, minutes, **other):
+    return {"points": points, "assists": 2.0, "rebounds": 4.0, "minutes": minutes, **other}
+
+
+indexes = {
+    "https://en.wikipedia.org/wiki/A": {
+        "2021": {"Milwaukee Bucks": stats(30.0, 36.0, steals=1.0, blocks=1.5)},
+        "2020": {"Milwaukee Bucks": stats(28.0, 33.0)},
+    },
+    "https://en.wikipedia.org/wiki/B": {"2021": {"Milwaukee Bucks": stats(10.0, 18.0)}},
+    "https://en.wikipedia.org/wiki/C": {"2021": {"Milwaukee Bucks": stats(20.0, 24.0)}},
+    "https://en.wikipedia.org/wiki/D": {"2021": {"Milwaukee Bucks": stats(0.0, 0.0)}},
+    "https://en.wikipedia.org/wiki/E": {
+        "2021": {
+            "Houston Rockets": stats(4.0, 12.0),
+            "Golden State Warriors": stats(12.0, 24.0),
+        },
+    },
+}
+
+
+@pytest.fixture
+def table():
+    return StatsTable.from_indexes(indexes, names={"https://en.wikipedia.org/wiki/A": "Player A"})
+
+
+def test_from_indexes(table):
+    assert len(table) == 7
+    assert set(table["name"]) == {"Player A", "B", "C", "D", "E"}
+    # missing stats are nan
+    assert np.isnan(table["steals"]).sum() == 6
+
+
+def test_builtin_metrics(table):
+    row = list(table["url"]).index("https://en.wikipedia.org/wiki/B")
+    assert table["points_per_36"][row] == 20.0
+    assert table["pra"][row] == 16.0
+    # 10 of the 60 points of the Bucks in 2021
+    assert table["scoring_share"][row] == pytest.approx(10 / 60)
+    # no minutes played, no per 36 rate
+    row = list(table["url"]).index("https://en.wikipedia.org/wiki/D")
+    assert np.isnan(table["points_per_36"][row])
+
+    table.compute()
+    assert set(metrics) <= set(table.columns)
+
+
+def test_group_zscore():
+    values = np.array([1.0, 2.0, 3.0, 10.0, np.nan, 10.0])
+    codes = group_codes(np.array(["a", "a", "a", "b", "b", "b"], dtype=object))
+    z = group_zscore(values, codes)
+    assert z[:3] == pytest.approx([-1.2247, 0.0, 1.2247], abs=1e-4)
+    # a group without spread and missing values have no z-score
+    assert np.isnan(z[3:]).all()
+
+
+def test_register_metric(table):
+    register_metric("double_points", lambda t: t["points"] * 2)
+    try:
+        assert table["double_points"].max() == 60.0
+    finally:
+        del metrics["double_points"]
+
+
+def test_rank(table):
+    best = rank(table, "points_per_36", season="2021", teams=["Milwaukee", "Golden State"])
+    assert set(best) == {"Milwaukee Bucks", "Golden State Warriors"}
+    assert [p["name"] for p in best["Milwaukee Bucks"]] == ["Player A", "C", "B"]
+    assert best["Milwaukee Bucks"][0]["points_per_36"] == 30.0
+    assert best["Golden State Warriors"][0]["points"] == 12.0
+    assert rank(table, "points", season="1999") == {}
+
+
+def test_leaders(table):
+    top = leaders(table, "points", season="2021", k=2)
+    assert top == [
+        {"name": "Player A", "team": "Milwaukee Bucks", "points": 30.0},
+        {"name": "C", "team": "Milwaukee Bucks", "points": 20.0},
+    ]
@@ -1,13 +1,24 @@
+import tracemalloc
 from operator import itemgetter
 from pathlib import Path
 
+import fetch_player_statistics
 import pytest
+import requesting_urls
 from fetch_player_statistics import (
     find_best_players,
     get_player_stats,
+    get_player_stats_index,
     get_players,
     get_teams,
+    load_stats_index,
+    parse_player_page,
+    refresh_best_players,
+    save_stats_index,
+    select_top_3,
+    stream_best_players,
 )
+from requesting_urls import FetchError
 
 playoff_url = "https://en.wikipedia.org/wiki/2022_NBA_playoffs"
 
@@ -127,6 +138,358 @@ def test_get_player_stats(player_url, team, stats):
         assert player_stats[key] == value
 
 
+career_html = """
+<h3><span id="Regular_season">Regular season</span></h3>
+<table>
+<tr><th>Year</th><th>Team</th><th>GP</th><th>GS</th><th>MPG</th><th>FG%</th>
+<th>3P%</th><th>FT%</th><th>RPG</th><th>APG</th><th>SPG</th><th>BPG</th><th>PPG</th></tr>
+<tr><td><a title="2020–21 NBA season">2020–21</a></td>
+<td><a title="2020–21 Milwaukee Bucks season">Milwaukee</a></td>
+<td>61</td><td>61</td><td>33.0</td><td>.569</td><td>.303</td><td>.685</td>
+<td>11.0</td><td>5.9</td><td>1.2</td><td>1.2</td><td>28.1</td></tr>
+<tr><td rowspan="2"><a title="2021–22 NBA season">2021–22</a></td>
+<td><a title="2021–22 Houston Rockets season">Houston</a></td>
+<td>20</td><td>0</td><td>12.0</td><td>.400</td><td>.300</td><td>.700</td>
+<td>2.0</td><td>1.0</td><td>0.5</td><td>0.1</td><td>4.5</td></tr>
+<tr><td><a title="2021–22 Golden State Warriors season">Golden State</a></td>
+<td>30</td><td>2</td><td>20.0</td><td>.450</td><td>.350</td><td>.800</td>
+<td>3.5</td><td>2.5</td><td>0.7</td><td>0.2</td><td>9.5*</td></tr>
+<tr><td colspan="2">Career</td>
+<td>111</td><td>63</td><td>25.0</td><td>.500</td><td>.310</td><td>.700</td>
+<td>7.0</td><td>4.0</td><td>1.0</td><td>0.8</td><td>19.0</td></tr>
+</table>
+"""
+
+
+@pytest.fixture
+def career_page(monkeypatch):
+    calls = []
+
+    def fake_get_html(url, refresh=False):
+        calls.append(url)
+        return career_html
+
+    monkeypatch.setattr(fetch_player_statistics, "get_html", fake_get_html)
+    monkeypatch.setattr(fetch_player_statistics, "_stats_index", {})
+    return calls
+
+
+def test_get_player_stats_index(career_page):
+    index = get_player_stats_index("https://en.wikipedia.org/wiki/Someone")
+    core = {
+        season: {
+            team: {key: stats[key] for key in ("points", "assists", "rebounds")}
+            for team, stats in teams.items()
+        }
+        for season, teams in index.items()
+    }
+    assert core == {
+        "2020": {
+            "Milwaukee Bucks": {"points": 28.1, "assists": 5.9, "rebounds": 11.0},
+        },
+        "2021": {
+            "Houston Rockets": {"points": 4.5, "assists": 1.0, "rebounds": 2.0},
+            "Golden State Warriors": {"points": 9.5, "assists": 2.5, "rebounds": 3.5},
+        },
+    }
+    # the other columns are read from the header
+    milwaukee = index["2020"]["Milwaukee Bucks"]
+    assert milwaukee["games"] == 61
+    assert milwaukee["minutes"] == 33.0
+    assert milwaukee["three_pct"] == 0.303
+    assert milwaukee["blocks"] == 1.2
+
+
+def test_get_player_stats_traded(career_page):
+    url = "https://en.wikipedia.org/wiki/Someone"
+    assert get_player_stats(url, "Golden State")["points"] == 9.5
+    assert get_player_stats(url, "Houston")["points"] == 4.5
+    assert get_player_stats(url, "Milwaukee", season="2020")["rebounds"] == 11.0
+    assert get_player_stats(url, "Milwaukee") == {}
+    # the page is only parsed once
+    assert career_page == [url]
+
+
+def test_stats_index_store(career_page, tmpdir):
+    url = "https://en.wikipedia.org/wiki/Someone"
+    index = get_player_stats_index(url)
+    path = str(tmpdir.join("index.json"))
+    save_stats_index(path)
+
+    fetch_player_statistics._stats_index.clear()
+    load_stats_index(path)
+    assert get_player_stats_index(url) == index
+    assert career_page == [url]
+
+
+def make_player_html(team, ppg):
+    return f"""
+    <span id="Regular_season"></span>
+    <table>
+    <tr><th>Year</th></tr>
+    <tr><td><a title="2021–22 NBA season">2021–22</a></td>
+    <td><a title="2021–22 {team} season">{team}</a></td>
+    <td>50</td><td>50</td><td>30.0</td><td>.500</td><td>.300</td><td>.800</td>
+    <td>5.0</td><td>4.0</td><td>1.0</td><td>0.5</td><td>{ppg}</td></tr>
+    </table>
+    """
+
+
+def make_wiki_pages(n_players=4, padding=""):
+    """Pages of an offline playoffs wiki: 8 teams with n_players each,
+    padding is added to every player page"""
+    pages = {}
+    teams = [f"Team{i}" for i in range(8)]
+    first_round = "".join(
+        f'<tr><td></td><td>E{i + 1}</td><td><a href="/wiki/{team}">{team}</a></td></tr>'
+        for i, team in enumerate(teams)
+    )
+    semifinal = "".join(
+        f"<tr><td></td><td></td><td>E{i + 1}</td><td>{team}</td></tr>"
+        for i, team in enumerate(teams)
+    )
+    pages[playoff_url] = (
+        '<span id="Bracket"></span><table><tr></tr><tr></tr>'
+        f"{first_round}{semifinal}</table>"
+    )
+    for team in teams:
+        roster = "".join(
+            f'<tr><td>G</td><td>{j}</td><td><a href="/wiki/{team}_{j}">{team}, {j}</a></td></tr>'
+            for j in range(n_players)
+        )
+        pages[f"https://en.wikipedia.org/wiki/{team}"] = (
+            f'<span id="Roster"></span><table><tr></tr><tr></tr><tr></tr>{roster}</table>'
+        )
+        for j in range(n_players):
+            pages[f"https://en.wikipedia.org/wiki/{team}_{j}"] = make_player_html(
+                team, 10.0 * (j + 1)
+            ) + padding
+    return pages
+
+
+@pytest.fixture
+def fake_wiki(monkeypatch):
+    """A small offline playoffs wiki: 8 teams with 4 players each"""
+    pages = make_wiki_pages()
+    wiki = {"pages": pages, "revisions": {url: 1 for url in pages}, "fetched": [], "plotted": []}
+
+    def fake_get_html(url, refresh=False):
+        wiki["fetched"].append(url)
+        return pages[url]
+
+    def fake_get_revision_ids(urls):
+        return {url: wiki["revisions"][url] for url in urls}
+
+    def fake_plot_best(best, stat):
+        wiki["plotted"].append(stat)
+        Path("results_graphs").mkdir(exist_ok=True)
+        Path("results_graphs", f"{stat}.png").touch()
+
+    monkeypatch.setattr(fetch_player_statistics, "get_html", fake_get_html)
+    monkeypatch.setattr(fetch_player_statistics, "get_revision_ids", fake_get_revision_ids)
+    monkeypatch.setattr(fetch_player_statistics, "plot_best", fake_plot_best)
+    monkeypatch.setattr(fetch_player_statistics, "_stats_index", {})
+    return wiki
+
+
+def test_refresh_best_players(fake_wiki, monkeypatch, tmpdir):
+    tmpdir.chdir()
+    refresh_best_players(playoff_url, state_path="state.json")
+    assert len(fake_wiki["fetched"]) == 1 + 8 + 8 * 4
+    assert fake_wiki["plotted"] == ["points", "assists", "rebounds"]
+
+    # nothing changed, nothing is fetched or plotted
+    fake_wiki["fetched"].clear()
+    fake_wiki["plotted"].clear()
+    fetch_player_statistics._stats_index.clear()
+    refresh_best_players(playoff_url, state_path="state.json")
+    assert fake_wiki["fetched"] == []
+    assert fake_wiki["plotted"] == []
+
+    # one player page changed, only that page is fetched
+    # and only the points plot is redrawn
+    changed = "https://en.wikipedia.org/wiki/Team3_3"
+    fake_wiki["pages"][changed] = make_player_html("Team3", 45.0)
+    fake_wiki["revisions"][changed] = 2
+    refresh_best_players(playoff_url, state_path="state.json")
+    assert fake_wiki["fetched"] == [changed]
+    assert fake_wiki["plotted"] == ["points"]
+
+    # changed pages that fail keep their old results, and are retried next time
+    team_page = "https://en.wikipedia.org/wiki/Team4"
+    player_page = "https://en.wikipedia.org/wiki/Team5_0"
+    fake_wiki["revisions"][team_page] = 2
+    fake_wiki["revisions"][player_page] = 2
+    fake_wiki["pages"][player_page] = make_player_html("Team5", 99.0)
+    fake_get_html = fetch_player_statistics.get_html
+
+    def failing_get_html(url, refresh=False):
+        if url in (team_page, player_page):
+            raise FetchError(url, "HTTP 503")
+        return fake_get_html(url, refresh)
+
+    monkeypatch.setattr(fetch_player_statistics, "get_html", failing_get_html)
+    fake_wiki["fetched"].clear()
+    fake_wiki["plotted"].clear()
+    refresh_best_players(playoff_url, state_path="state.json")
+    assert fake_wiki["plotted"] == []
+
+    monkeypatch.setattr(fetch_player_statistics, "get_html", fake_get_html)
+    refresh_best_players(playoff_url, state_path="state.json")
+    assert sorted(fake_wiki["fetched"]) == [team_page, player_page]
+    assert "points" in fake_wiki["plotted"]
+
+
+def test_find_best_players_api(fake_wiki, monkeypatch, tmpdir):
+    tmpdir.chdir()
+    batches = []
+
+    def fake_get_sections_html(urls, section_names):
+        batches.append(list(urls))
+        return {url: fake_wiki["pages"][url] for url in urls}
+
+    monkeypatch.setattr(fetch_player_statistics, "get_sections_html", fake_get_sections_html)
+    find_best_players(playoff_url, use_api=True)
+    assert fake_wiki["fetched"] == []
+    assert [len(batch) for batch in batches] == [1, 8, 8 * 4]
+    assert fake_wiki["plotted"] == ["points", "assists", "rebounds"]
+
+
+def test_find_best_players_api_fallback(fake_wiki, monkeypatch, tmpdir):
+    tmpdir.chdir()
+    no_section = {playoff_url, "https://en.wikipedia.org/wiki/Team3_1"}
+
+    def fake_get_sections_html(urls, section_names):
+        if section_names == ["Roster"]:
+            raise FetchError(urls[0], "HTTP 503")
+        return {url: "" if url in no_section else fake_wiki["pages"][url] for url in urls}
+
+    monkeypatch.setattr(fetch_player_statistics, "get_sections_html", fake_get_sections_html)
+    all_players = fetch_player_statistics.collect_players(playoff_url, use_api=True)
+    # the missing sections and the failed roster batch are fetched as full pages
+    assert playoff_url in fake_wiki["fetched"]
+    assert len(all_players) == 8
+    assert all(len(players) == 4 for players in all_players.values())
+    assert "https://en.wikipedia.org/wiki/Team3_1" in fake_wiki["fetched"]
+    assert all_players["Team3"][1]["points"] == 20.0
+
+
+def test_find_best_players_failed_pages(fake_wiki, monkeypatch, tmpdir):
+    tmpdir.chdir()
+    broken = {"https://en.wikipedia.org/wiki/Team1", "https://en.wikipedia.org/wiki/Team2_3"}
+    fake_get_html = fetch_player_statistics.get_html
+
+    def flaky_get_html(url, refresh=False):
+        if url in broken:
+            raise FetchError(url, "HTTP 503")
+        return fake_get_html(url)
+
+    monkeypatch.setattr(fetch_player_statistics, "get_html", flaky_get_html)
+    find_best_players(playoff_url)
+    # the run finishes without the failed team and player
+    assert fake_wiki["plotted"] == ["points", "assists", "rebounds"]
+    assert "https://en.wikipedia.org/wiki/Team1_0" not in fake_wiki["fetched"]
+
+
+def test_find_best_players_resume(fake_wiki, monkeypatch, tmpdir):
+    tmpdir.chdir()
+    crash_at = "https://en.wikipedia.org/wiki/Team5_0"
+    fake_get_html = fetch_player_statistics.get_html
+
+    def crashing_get_html(url, refresh=False):
+        if url == crash_at:
+            raise RuntimeError("crash")
+        return fake_get_html(url)
+
+    monkeypatch.setattr(fetch_player_statistics, "get_html", crashing_get_html)
+    with pytest.raises(RuntimeError):
+        find_best_players(playoff_url, journal_path="run.journal")
+    fetched_before_crash = list(fake_wiki["fetched"])
+    assert fake_wiki["plotted"] == []
+
+    # restart in a new process: nothing finished is fetched again
+    fetch_player_statistics._stats_index.clear()
+    fake_wiki["fetched"].clear()
+    monkeypatch.setattr(fetch_player_statistics, "get_html", fake_get_html)
+    find_best_players(playoff_url, journal_path="run.journal")
+    assert crash_at in fake_wiki["fetched"]
+    assert not set(fake_wiki["fetched"]) & set(fetched_before_crash)
+    assert len(fake_wiki["fetched"]) + len(fetched_before_crash) == 1 + 8 + 8 * 4
+    assert fake_wiki["plotted"] == ["points", "assists", "rebounds"]
+
+    # the finished run is not replayed again
+    assert not Path("run.journal").exists()
+    fetch_player_statistics._stats_index.clear()
+    fake_wiki["fetched"].clear()
+    find_best_players(playoff_url, journal_path="run.journal")
+    assert len(fake_wiki["fetched"]) == 1 + 8 + 8 * 4
+
+
+def test_find_best_players_index(fake_wiki, tmpdir):
+    tmpdir.chdir()
+    find_best_players(playoff_url, index_path="player_stats.json")
+    assert len(fake_wiki["fetched"]) == 1 + 8 + 8 * 4
+
+    # a new process parses no player page again
+    fetch_player_statistics._stats_index.clear()
+    fake_wiki["fetched"].clear()
+    find_best_players(playoff_url, index_path="player_stats.json")
+    assert len(fake_wiki["fetched"]) == 1 + 8
+    assert fake_wiki["plotted"] == ["points", "assists", "rebounds"] * 2
+
+
+def test_find_best_players_low_memory(fake_wiki, monkeypatch, tmpdir):
+    tmpdir.chdir()
+    monkeypatch.setattr(requesting_urls, "memory_budget", None)
+    limits = set()
+    fake_get_html = fetch_player_statistics.get_html
+
+    def checked_get_html(url, refresh=False):
+        limits.add(requesting_urls.memory_budget.limit)
+        return fake_get_html(url)
+
+    monkeypatch.setattr(fetch_player_statistics, "get_html", checked_get_html)
+    find_best_players(playoff_url, memory_budget=2**40)
+    assert limits == {2**40}
+    # later runs in the process are not checked against the budget
+    assert requesting_urls.memory_budget is None
+    monkeypatch.setattr(fetch_player_statistics, "get_html", fake_get_html)
+    assert len(fake_wiki["fetched"]) == 1 + 8 + 8 * 4
+    assert fake_wiki["plotted"] == ["points", "assists", "rebounds"]
+    # player stats are not kept
+    assert fetch_player_statistics._stats_index == {}
+
+    # the same top 3s as the default mode
+    all_players = fetch_player_statistics.collect_players(playoff_url)
+    expected = {team: select_top_3(players) for team, players in all_players.items()}
+    assert dict(stream_best_players(playoff_url)) == expected
+
+
+def test_stream_best_players_memory(monkeypatch):
+    """Peak memory of the low-memory mode is about one parse tree,
+    however many pages are fetched"""
+    padding = "<ul>" + '<li><a href="/wiki/Link">Some link</a></li>' * 100 + "</ul>"
+    pages = make_wiki_pages(1, padding)
+    tracemalloc.start()
+    parse_player_page(pages["https://en.wikipedia.org/wiki/Team0_0"])
+    tree_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    peaks = {}
+    for n_players in (1, 4):
+        pages = make_wiki_pages(n_players, padding)
+        monkeypatch.setattr(fetch_player_statistics, "get_html", lambda url, refresh=False: pages[url])
+        monkeypatch.setattr(fetch_player_statistics, "_stats_index", {})
+        tracemalloc.start()
+        best = dict(stream_best_players(playoff_url))
+        peaks[n_players] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert [len(top_3) for top_3 in best.values()] == [min(n_players, 3)] * 8
+
+    assert peaks[4] < 1.2 * peaks[1]
+    assert peaks[4] < 2 * tree_peak
+
+
 def test_find_best_players(tmpdir):
     tmpdir.chdir()
     find_best_players(playoff_url)
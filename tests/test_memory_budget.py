@@ -0,0 +1,61 @@
+import multiprocessing
+
+import pytest
+
+import memory_budget
+from memory_budget import MemoryBudget, benchmark, current_rss, megabyte
+
+
+def test_current_rss():
+    assert current_rss() > megabyte
+
+
+def test_under_budget():
+    budget = MemoryBudget(100, measure=lambda: 50)
+    budget.check()
+    assert budget.releases == 0
+    assert budget.peak == 50
+
+
+def test_release_memory():
+    # memory is freed by the time of the second measurement
+    readings = iter([150, 80])
+    budget = MemoryBudget(100, measure=lambda: next(readings))
+    budget.check()
+    assert budget.releases == 1
+    assert budget.overruns == 0
+    assert budget.peak == 150
+
+
+def test_overrun(capsys):
+    budget = MemoryBudget(100 * megabyte, measure=lambda: 150 * megabyte)
+    for _ in range(3):
+        budget.check()
+    assert budget.overruns == 3
+    # warned once, not for every fetch
+    assert capsys.readouterr().out == "Memory use 150 MB is over the budget of 100 MB\n"
+
+
+def fake_run(url, memory_budget, results):
+    results.put(100 * megabyte if memory_budget is None else 50 * megabyte)
+
+
+def test_benchmark(monkeypatch):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the child needs the patched _measure_run")
+    monkeypatch.setattr(memory_budget, "_measure_run", fake_run)
+    peaks = benchmark("https://a", memory_budget=64 * megabyte)
+    assert peaks == {"default": 100.0, "low_memory": 50.0, "budget": 64.0, "within_budget": True}
+    assert not benchmark("https://a", memory_budget=32 * megabyte)["within_budget"]
+
+
+def failing_run(url, memory_budget, results):
+    raise ValueError("no page")
+
+
+def test_benchmark_failing_run(monkeypatch):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the child needs the patched _measure_run")
+    monkeypatch.setattr(memory_budget, "_measure_run", failing_run)
+    with pytest.raises(RuntimeError, match="exit code 1"):
+        benchmark("https://a")
@@ -0,0 +1,77 @@
+import os
+import threading
+from time import perf_counter, sleep
+
+import profiling
+from profiling import Profiler, merge_profiles, profile_call, stage
+
+
+def busy_parse(seconds):
+    end = perf_counter() + seconds
+    total = 0
+    while perf_counter() < end:
+        total += sum(range(100))
+    return total
+
+
+def fetch_and_parse(url):
+    with stage("network", url):
+        sleep(0.05)
+    with stage("parse", url):
+        busy_parse(0.1)
+
+
+def test_stage_without_profiler():
+    assert profiling._active is None
+    with stage("network", "https://a"):
+        pass
+
+
+def test_profiler(tmpdir):
+    output_dir = str(tmpdir.join("profile"))
+    with Profiler(output_dir, interval=0.002) as profiler:
+        worker = threading.Thread(target=fetch_and_parse, args=("https://b",), name="worker")
+        worker.start()
+        fetch_and_parse("https://a")
+        worker.join()
+    assert profiling._active is None
+
+    # time per stage and url, from both threads
+    assert set(profiler.stages) == {"network", "parse"}
+    calls, seconds = profiler.stages["network"]["https://b"]
+    assert calls == 1 and seconds >= 0.05
+
+    # the cProfile covers the worker thread too
+    functions = {function for _, _, function in profiler.cpu_stats().stats}
+    assert {"fetch_and_parse", "busy_parse"} <= functions
+
+    # sampled stacks start with the thread and stage
+    pid = os.getpid()
+    with open(os.path.join(output_dir, f"stacks.{pid}.folded")) as f:
+        lines = f.read().splitlines()
+    assert any(line.startswith("worker;stage:parse;") and "busy_parse" in line for line in lines)
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    assert os.path.exists(os.path.join(output_dir, f"cpu.{pid}.prof"))
+
+    summary = merge_profiles(output_dir, top=5)
+    assert "https://a" in summary and "https://b" in summary
+    assert "busy_parse" in summary
+    assert os.path.exists(os.path.join(output_dir, "stacks.folded"))
+    assert os.path.exists(os.path.join(output_dir, "summary.txt"))
+
+
+def test_earlier_runs_not_merged(tmpdir):
+    output_dir = str(tmpdir)
+    profile_call(fetch_and_parse, "https://old", output_dir=output_dir)
+    # as if the first run was another process
+    pid = os.getpid()
+    for name in ["cpu.{}.prof", "stacks.{}.folded", "stages.{}.json"]:
+        os.rename(os.path.join(output_dir, name.format(pid)), os.path.join(output_dir, name.format(1)))
+
+    profile_call(fetch_and_parse, "https://new", output_dir=output_dir)
+    with open(os.path.join(output_dir, "summary.txt")) as f:
+        summary = f.read()
+    assert "https://new" in summary
+    assert "https://old" not in summary
@@ -1,7 +1,22 @@
 # Test with no params
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
 import pytest
+import requesting_urls
 from bs4 import BeautifulSoup
-from requesting_urls import get_html
+from requesting_urls import (
+    CircuitBreaker,
+    FetchError,
+    TokenBucket,
+    backoff_delay,
+    get_html,
+    get_sections_html,
+    title_from_url,
+    use_snapshot_archive,
+)
 
 
 @pytest.mark.parametrize(
@@ -18,3 +33,223 @@ def test_get_html_no_params(url, expected):
     assert "<!DOCTYPE" in html
     assert "<html" in html
     assert expected in html
+
+
+@pytest.mark.parametrize(
+    "url, title",
+    [
+        ("https://en.wikipedia.org/wiki/Star_Wars", "Star Wars"),
+        ("https://en.wikipedia.org/wiki/Dungeons_%26_Dragons", "Dungeons & Dragons"),
+        ("https://en.wikipedia.org/wiki/2022_NBA_playoffs#Bracket", "2022 NBA playoffs"),
+    ],
+)
+def test_title_from_url(url, title):
+    assert title_from_url(url) == title
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Stand-in for the MediaWiki API, replaying canned responses by action"""
+
+    def do_GET(self):
+        self.reply(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        self.reply(parse_qs(self.rfile.read(length).decode()))
+
+    def reply(self, params):
+        self.server.received.append(params)
+        body = json.dumps(self.server.responses[params["action"][0]]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_server(monkeypatch):
+    server = HTTPServer(("127.0.0.1", 0), ReplayHandler)
+    server.responses = {}
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(
+        requesting_urls, "api_url", f"http://127.0.0.1:{server.server_port}/w/api.php"
+    )
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_sections_html(api_server):
+    career = "==NBA career statistics==\n===Regular season===\n{|\n|28.1\n|}\n===Playoffs===\n{|\n|30.2\n|}\n"
+    api_server.responses["query"] = {
+        "query": {
+            "normalized": [{"from": "Giannis_Antetokounmpo", "to": "Giannis Antetokounmpo"}],
+            "pages": [
+                {"title": "Giannis Antetokounmpo", "revisions": [{"slots": {"main": {"content": career}}}]},
+                {"title": "Stephen Curry", "revisions": [{"slots": {"main": {"content": "==NBA==\n{|\n|25.5\n|}"}}}]},
+                {"title": "No Stats", "revisions": [{"slots": {"main": {"content": "==Early life=="}}}]},
+            ],
+        }
+    }
+    api_server.responses["parse"] = {
+        "parse": {
+            "text": '<div class="mw-parser-output">'
+            '<div class="nba-statistics-section" data-index="0"><table><tr><td>28.1</td></tr></table></div>'
+            '<div class="nba-statistics-section" data-index="1"><table><tr><td>25.5</td></tr></table></div>'
+            "</div>"
+        }
+    }
+    base = "https://en.wikipedia.org/wiki/"
+    urls = [base + "Giannis_Antetokounmpo", base + "Stephen_Curry", base + "No_Stats"]
+    pages = get_sections_html(urls, ["Regular season", "NBA"])
+
+    # one query and one parse request for all pages
+    assert [params["action"][0] for params in api_server.received] == ["query", "parse"]
+    # only the needed section is sent to be rendered
+    text = api_server.received[1]["text"][0]
+    assert "28.1" in text and "25.5" in text
+    assert "30.2" not in text
+
+    giannis = BeautifulSoup(pages[urls[0]], "html.parser")
+    assert giannis.find(id="Regular_season").find_next("table").td.text == "28.1"
+    curry = BeautifulSoup(pages[urls[1]], "html.parser")
+    assert curry.find(id="NBA").find_next("table").td.text == "25.5"
+    assert pages[urls[2]] == ""
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """Answers with the next (status, headers, body) of a script"""
+
+    def do_GET(self):
+        status, headers, body = self.server.script.pop(0)
+        body = body.encode()
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def flaky_server(monkeypatch):
+    server = HTTPServer(("127.0.0.1", 0), ScriptedHandler)
+    server.script = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    sleeps = []
+    monkeypatch.setattr(requesting_urls, "sleep", sleeps.append)
+    monkeypatch.setattr(requesting_urls, "_breakers", {})
+    monkeypatch.setattr(requesting_urls, "failures", {})
+    server.url = f"http://127.0.0.1:{server.server_port}/wiki/Page"
+    server.sleeps = sleeps
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_html_retries(flaky_server):
+    flaky_server.script = [
+        (429, {"Retry-After": "7"}, "slow down"),
+        (503, {}, "unavailable"),
+        (200, {}, "<html>page</html>"),
+    ]
+    assert get_html(flaky_server.url) == "<html>page</html>"
+    assert len(flaky_server.sleeps) == 2
+    # the Retry-After header is honored
+    assert flaky_server.sleeps[0] >= 7
+
+
+def test_get_html_long_retry_after(flaky_server):
+    flaky_server.script = [(503, {"Retry-After": "3600"}, "come back later")]
+    with pytest.raises(FetchError, match="retry after 3600"):
+        get_html(flaky_server.url)
+    # the url fails instead of blocking the crawl for an hour
+    assert flaky_server.sleeps == []
+
+
+def test_get_html_gives_up(flaky_server):
+    flaky_server.script = [(503, {}, "unavailable")] * 6
+    with pytest.raises(FetchError):
+        get_html(flaky_server.url)
+    assert requesting_urls.failures[flaky_server.url] == "HTTP 503"
+
+
+def test_get_html_bad_page(flaky_server):
+    # one page keeps failing, the pages after it are still fetched
+    flaky_server.script = [(500, {}, "error")] * 6 + [(200, {}, "<html>page</html>")] * 10
+    with pytest.raises(FetchError, match="HTTP 500"):
+        get_html(flaky_server.url + "_bad")
+    for _ in range(10):
+        assert get_html(flaky_server.url) == "<html>page</html>"
+    assert requesting_urls.failures == {flaky_server.url + "_bad": "HTTP 500"}
+
+
+def test_get_html_circuit_open(flaky_server, monkeypatch):
+    host = "127.0.0.1:{}".format(flaky_server.server_port)
+    monkeypatch.setattr(requesting_urls, "_breakers", {host: CircuitBreaker(threshold=2, cooldown=30)})
+    flaky_server.script = [(503, {}, "unavailable")] * 12 + [(200, {}, "<html>page</html>")]
+    for _ in range(2):
+        with pytest.raises(FetchError, match="HTTP 503"):
+            get_html(flaky_server.url)
+    # the host keeps failing, so the next request waits out the cooldown instead of failing
+    del flaky_server.sleeps[:]
+    assert get_html(flaky_server.url) == "<html>page</html>"
+    assert flaky_server.sleeps[0] > 29
+
+
+def test_get_html_not_found(flaky_server):
+    flaky_server.script = [(404, {}, "no such page")]
+    with pytest.raises(FetchError, match="HTTP 404"):
+        get_html(flaky_server.url)
+    # client errors are not retried
+    assert flaky_server.sleeps == []
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt) <= min(60, 0.5 * 2 ** attempt)
+    assert backoff_delay(0, retry_after=3.0) == 3.0
+    assert backoff_delay(0, retry_after=3600.0) == 60.0
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    breaker.cooldown = 0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.failures == 0
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1000, capacity=5)
+    for _ in range(20):
+        bucket.acquire()
+    assert bucket.tokens < 5
+
+
+def test_get_html_archive(flaky_server, monkeypatch, tmpdir):
+    monkeypatch.setattr(requesting_urls, "archive", None)
+    archive = use_snapshot_archive(str(tmpdir))
+    flaky_server.script = [(200, {}, "<html>first</html>"), (200, {}, "<html>second</html>")]
+    assert get_html(flaky_server.url) == "<html>first</html>"
+    # served from the archive, without a request
+    assert get_html(flaky_server.url) == "<html>first</html>"
+    assert len(flaky_server.script) == 1
+    # a refresh fetches and stores a new snapshot
+    assert get_html(flaky_server.url, refresh=True) == "<html>second</html>"
+    assert archive.get(flaky_server.url) == "<html>second</html>"
+    archive.close()
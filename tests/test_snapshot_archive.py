@@ -0,0 +1,124 @@
+import random
+
+from snapshot_archive import SnapshotArchive, train_dictionary
+
+random.seed(0)
+words = ["".join(random.choice("abcdefghij") for _ in range(6)) for _ in range(2000)]
+navbox = "".join(
+    f'<tr><td class="navbox-list"><a href="/wiki/Player_{i}" title="Player {i}">Player {i}</a></td></tr>\n'
+    for i in range(500)
+)
+
+
+def make_page(n):
+    text = "".join(
+        "<p>" + " ".join(random.choice(words) for _ in range(40)) + "</p>\n"
+        for _ in range(30)
+    )
+    return f"<html><h1>Page {n}</h1>\n{text}{navbox}</html>\n"
+
+
+def test_put_and_get(tmpdir):
+    pages = {f"https://en.wikipedia.org/wiki/{i}": make_page(i) for i in range(10)}
+    with SnapshotArchive(str(tmpdir)) as archive:
+        for url, html in pages.items():
+            archive.put(url, html)
+        assert archive.get("https://en.wikipedia.org/wiki/missing") is None
+        for url, html in pages.items():
+            assert archive.get(url) == html
+
+    # a new process reads the pages back from the pack
+    with SnapshotArchive(str(tmpdir)) as archive:
+        for url, html in pages.items():
+            assert archive.get(url) == html
+
+
+def test_deduplication_and_compaction(tmpdir):
+    pages = {f"https://en.wikipedia.org/wiki/{i}": make_page(i) for i in range(20)}
+    raw_size = sum(len(html.encode()) for html in pages.values())
+    with SnapshotArchive(str(tmpdir)) as archive:
+        for url, html in pages.items():
+            archive.put(url, html)
+        # storing the same page again adds nothing
+        archive.put("https://en.wikipedia.org/wiki/copy", pages["https://en.wikipedia.org/wiki/0"])
+        archive.flush()
+        assert archive.size() * 4 < raw_size
+
+        archive.compact()
+        assert archive.size() * 4 < raw_size
+        for url, html in pages.items():
+            assert archive.get(url) == html
+
+
+def test_split_resyncs(tmpdir):
+    archive = SnapshotArchive(str(tmpdir))
+    # different beginnings, the shared navbox is cut into the same chunks
+    a = set(archive.split(make_page(1).encode()))
+    b = set(archive.split(make_page(2).encode()))
+    assert len(a & b) >= 2
+    archive.close()
+
+
+def test_compact_with_dictionary(tmpdir):
+    # pages sharing lots of markup, but no whole chunks
+    pages = {
+        f"https://en.wikipedia.org/wiki/{i}": "".join(
+            f'<li class="mw-list-item"><a href="/wiki/{random.choice(words)}" title="{random.choice(words)}">x</a></li>\n'
+            for _ in range(300)
+        )
+        for i in range(20)
+    }
+    with SnapshotArchive(str(tmpdir)) as archive:
+        for url, html in pages.items():
+            archive.put(url, html)
+        archive.flush()
+        size = archive.size()
+        archive.compact()
+        assert archive.dictionary
+        assert archive.size() < size
+        for url, html in pages.items():
+            assert archive.get(url) == html
+
+
+def test_train_dictionary():
+    samples = [b'<td class="navbox-list">x</td>' * 3, b'<td class="navbox-list">y</td>']
+    dictionary = train_dictionary(samples, size=64)
+    assert b'<td class="navbox-list">' in dictionary
+    assert len(dictionary) <= 64
+
+
+def test_compact_on_close(tmpdir):
+    pages = {f"https://en.wikipedia.org/wiki/{i}": make_page(i) for i in range(6)}
+    with SnapshotArchive(str(tmpdir), compact_after=5) as archive:
+        for url, html in pages.items():
+            archive.put(url, html)
+    with SnapshotArchive(str(tmpdir), compact_after=5) as archive:
+        assert archive.generation == 1
+        assert archive.uncompacted == 0
+        for url, html in pages.items():
+            assert archive.get(url) == html
+    # the files of the old generation are gone
+    assert sorted(p.basename for p in tmpdir.listdir()) == ["dictionary.1", "index.json", "pack.1"]
+
+
+def test_crash_while_compacting(tmpdir, monkeypatch):
+    pages = {f"https://en.wikipedia.org/wiki/{i}": make_page(i) for i in range(10)}
+    archive = SnapshotArchive(str(tmpdir))
+    for url, html in pages.items():
+        archive.put(url, html)
+    archive.flush()
+
+    def crash(*args):
+        raise RuntimeError("crash")
+
+    monkeypatch.setattr(archive, "_save_index", crash)
+    try:
+        archive.compact()
+    except RuntimeError:
+        pass
+
+    # the old pack, dictionary and index are still consistent
+    with SnapshotArchive(str(tmpdir)) as archive:
+        assert archive.generation == 0
+        for url, html in pages.items():
+            assert archive.get(url) == html
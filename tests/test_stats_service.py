@@ -0,0 +1,198 @@
+import json
+import socket
+import threading
+from time import sleep
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import fetch_player_statistics
+import pytest
+from stats_service import LRUCache, StatsService, load_test, serve
+from test_fetch_player_statistics import make_player_html, make_wiki_pages, playoff_url
+
+all_players = {
+    "Milwaukee": [
+        {"name": "Antetokounmpo, Giannis", "url": "https://en.wikipedia.org/wiki/Giannis"},
+        {"name": "Holiday, Jrue", "url": "https://en.wikipedia.org/wiki/Jrue"},
+    ],
+    "Golden State": [
+        {"name": "Curry, Stephen", "url": "https://en.wikipedia.org/wiki/Curry"},
+    ],
+}
+indexes = {
+    "https://en.wikipedia.org/wiki/Giannis": {
+        "2021": {"Milwaukee Bucks": {"points": 29.9, "assists": 5.8, "rebounds": 11.6, "minutes": 32.9}},
+    },
+    "https://en.wikipedia.org/wiki/Jrue": {
+        "2021": {"Milwaukee Bucks": {"points": 18.3, "assists": 6.8, "rebounds": 4.5, "minutes": 32.9}},
+    },
+    "https://en.wikipedia.org/wiki/Curry": {
+        "2021": {"Golden State Warriors": {"points": 25.5, "assists": 6.3, "rebounds": 5.2, "minutes": 34.5}},
+        "2020": {"Golden State Warriors": {"points": 32.0, "assists": 5.8, "rebounds": 5.5, "minutes": 34.2}},
+    },
+}
+
+
+@pytest.fixture
+def server():
+    service = StatsService()
+    service.load(all_players, indexes)
+    server = serve(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.base_url = f"http://127.0.0.1:{server.server_port}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path):
+    with urlopen(server.base_url + path) as response:
+        return json.loads(response.read())
+
+
+def test_queries(server):
+    assert get(server, "/teams") == ["Golden State", "Milwaukee"]
+
+    top = get(server, "/top?stat=points&k=1")
+    assert top["Milwaukee Bucks"][0]["name"] == "Antetokounmpo, Giannis"
+    assert top["Golden State Warriors"][0]["points"] == 25.5
+
+    top = get(server, "/top?stat=assists&team=Milwaukee")
+    assert list(top) == ["Milwaukee Bucks"]
+    assert top["Milwaukee Bucks"][0]["name"] == "Holiday, Jrue"
+
+    leaders = get(server, "/leaders?stat=points_per_36&k=2")
+    assert [p["name"] for p in leaders] == ["Antetokounmpo, Giannis", "Curry, Stephen"]
+
+    seasons = get(server, "/player?name=curry")
+    assert sorted(p["season"] for p in seasons) == ["2020", "2021"]
+    # stats missing from the tables are null
+    assert seasons[0]["steals"] is None
+
+
+def test_bad_queries(server, monkeypatch):
+    for path, error in [
+        ("/top?stat=nonsense", "unknown stat nonsense"),
+        ("/top?stat=name", "not a numeric stat: name"),
+        ("/top?stat=points&colour=red", "bad parameters"),
+        ("/player", "bad parameters"),
+    ]:
+        with pytest.raises(HTTPError) as e:
+            get(server, path)
+        assert e.value.code == 400
+        assert error in json.loads(e.value.read())["error"]
+    with pytest.raises(HTTPError) as e:
+        get(server, "/nowhere")
+    assert e.value.code == 404
+
+    # bugs are not blamed on the query
+    def broken():
+        raise TypeError("broken")
+
+    monkeypatch.setattr(server.service, "get_teams", broken)
+    with pytest.raises(HTTPError) as e:
+        get(server, "/teams")
+    assert e.value.code == 500
+
+
+def test_cache(server):
+    service = server.service
+    get(server, "/top?stat=points")
+    get(server, "/top?stat=points")
+    assert (service.cache.hits, service.cache.misses) == (1, 1)
+    # new stats are not answered from the cache
+    service.load(all_players, indexes)
+    get(server, "/top?stat=points")
+    assert service.cache.misses == 2
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.get("a", lambda: 1)
+    cache.get("b", lambda: 2)
+    cache.get("a", lambda: 0)
+    cache.get("c", lambda: 3)
+    assert list(cache.data) == ["a", "c"]
+
+
+def test_chart(server, tmpdir):
+    with urlopen(server.base_url + "/chart?stat=points") as response:
+        assert response.headers["Content-Type"] == "image/png"
+        assert response.read().startswith(b"\x89PNG")
+
+
+def test_background_refresh(server, monkeypatch):
+    refreshed = threading.Event()
+
+    def fake_collect_players(url, refresh=False):
+        fetch_player_statistics._stats_index.update(indexes)
+        refreshed.set()
+        return {"Milwaukee": all_players["Milwaukee"]}
+
+    monkeypatch.setattr(fetch_player_statistics, "collect_players", fake_collect_players)
+    request = Request(server.base_url + "/refresh", method="POST")
+    with urlopen(request) as response:
+        assert response.status == 202
+    assert refreshed.wait(5)
+    for _ in range(100):
+        if not get(server, "/status")["refreshing"]:
+            break
+        sleep(0.01)
+    assert get(server, "/teams") == ["Milwaukee"]
+    assert get(server, "/status")["version"] == 2
+
+
+def test_refresh_fetches_fresh_pages(monkeypatch):
+    pages = make_wiki_pages()
+    fetched = []
+
+    def fake_get_html(url, refresh=False):
+        fetched.append((url, refresh))
+        return pages[url]
+
+    monkeypatch.setattr(fetch_player_statistics, "get_html", fake_get_html)
+    monkeypatch.setattr(fetch_player_statistics, "_stats_index", {})
+    service = StatsService(playoff_url)
+    service.refresh()
+    _, _, body = service.query("/top", {"stat": "points", "k": "1"})
+    assert json.loads(body)["Team3"][0]["points"] == 40.0
+
+    # a player page changed, the next refresh sees it
+    pages["https://en.wikipedia.org/wiki/Team3_3"] = make_player_html("Team3", 99.0)
+    fetched.clear()
+    service.refresh()
+    _, _, body = service.query("/top", {"stat": "points", "k": "1"})
+    assert json.loads(body)["Team3"][0]["points"] == 99.0
+    assert len(fetched) == 1 + 8 + 8 * 4
+    assert all(refresh for url, refresh in fetched)
+
+
+def test_load_test(server):
+    paths = ["/teams", "/top?stat=points", "/leaders?stat=pra", "/player?name=Jrue"]
+    results = load_test(server.base_url, paths, requests=200, concurrency=4)
+    assert results["errors"] == 0
+    assert results["p50"] <= results["p99"] <= results["max"]
+    assert server.service.cache.hits >= 190
+
+
+def test_load_test_dropped_connections():
+    # a server that hangs up on every request
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+
+    def hang_up():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            connection.recv(1024)
+            connection.close()
+
+    threading.Thread(target=hang_up, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(listener.getsockname()[1])
+    results = load_test(base_url, ["/teams"], requests=10, concurrency=2)
+    listener.close()
+    assert results["errors"] == 10